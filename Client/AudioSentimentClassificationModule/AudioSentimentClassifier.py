@@ -1,52 +1,277 @@
 import os
+import time
 import librosa
 import numpy as np
+import soxr
 import tensorflow as tf
-from pydub import AudioSegment
 from dotenv import load_dotenv
 
 env_path = os.path.join(os.path.dirname(__file__), '..', '.env')
 load_dotenv(env_path)
 
 MODEL_PATH = os.getenv("TFLITE_MODEL_PATH")
+# threads used by the TFLite interpreter, None lets TFLite choose
+TFLITE_NUM_THREADS = int(os.getenv("TFLITE_NUM_THREADS")) if os.getenv("TFLITE_NUM_THREADS") else None
+
+class UtteranceFeatures:
+    """
+    the features of a speech file shared by the classifier and all the engagement estimators:
+    the file is decoded and resampled only once, MFCCs and non-silent intervals are computed on first use and then reused
+    """
+
+    def __init__(self, audio_file, sampling_rate = 22050, data = None):
+        """
+        audio_file: path to the speech file, or just a name for the speech if its samples are given as data
+        data: the samples of the speech, already at sampling_rate, instead of reading them from audio_file
+        """
+        self.audio_file = audio_file
+        if data is None:
+            data, sampling_rate = librosa.load(audio_file, sr=sampling_rate)
+        self.data, self.sampling_rate = data, sampling_rate
+        # seconds
+        self.duration = len(self.data) / self.sampling_rate
+        self.__mfccs = None
+        self.__mfcc_frames = None
+        self.__non_silent_intervals = None
+
+    @classmethod
+    def from_pcm(cls, name, pcm, pcm_sampling_rate, sampling_rate = 22050):
+        """
+        returns the features of a speech recorded in memory as 16-bit PCM, resampled as librosa.load would do
+        """
+        data = np.asarray(pcm, dtype=np.float32) / 32768.0
+        if pcm_sampling_rate != sampling_rate:
+            data = librosa.resample(data, orig_sr=pcm_sampling_rate, target_sr=sampling_rate)
+        return cls(name, sampling_rate, data)
+
+    @property
+    def mfccs(self):
+        """
+        the 40 MFCCs averaged over time, the input of the sentiment classifier
+        """
+        if self.__mfccs is None:
+            self.__compute_mfccs()
+        return self.__mfccs
+
+    @property
+    def mfcc_frames(self):
+        """
+        the number of frames the MFCCs were averaged over
+        """
+        if self.__mfcc_frames is None:
+            self.__compute_mfccs()
+        return self.__mfcc_frames
+
+    def __compute_mfccs(self):
+        mfccs = librosa.feature.mfcc(y=self.data, sr=self.sampling_rate, n_mfcc=40)
+        self.__mfccs, self.__mfcc_frames = np.mean(mfccs.T, axis=0), mfccs.shape[1]
+
+    @property
+    def non_silent_intervals(self):
+        if self.__non_silent_intervals is None:
+            self.__non_silent_intervals = len(librosa.effects.split(self.data))
+        return self.__non_silent_intervals
+
+    @property
+    def speech_rate(self):
+        """
+        the number of non-silent intervals per second
+        """
+        return self.non_silent_intervals / self.duration if self.duration > 0 else 0
+
+class RunningFeatures:
+    """
+    the features of all the speech slices of a speaker, recorded in memory as 16-bit PCM, computed while the slices
+    arrive so that they are ready as soon as the last one ends. The slices are resampled as one stream and framed as
+    librosa frames their concatenation (same window, hop and zero padding at the edges), keeping the mel power and the
+    rms of every frame: the MFCCs and the non-silent intervals are then computed over all the frames, against the
+    maximum of the whole speech as librosa does. After finish() they are the features UtteranceFeatures.from_pcm()
+    gives for the merged speech; before, they cover the frames completed so far
+    """
+
+    N_FFT = 2048
+    HOP_LENGTH = 512
+    # as librosa.effects.split
+    TOP_DB = 60
+
+    def __init__(self, name, pcm_sampling_rate, sampling_rate = 22050):
+        self.audio_file = name
+        self.pcm_sampling_rate = pcm_sampling_rate
+        self.sampling_rate = sampling_rate
+        self.segments = 0
+        self.finished = False
+        # resampled as librosa.resample does, keeping the filter state between the slices
+        self.__resampler = soxr.ResampleStream(pcm_sampling_rate, sampling_rate, 1, dtype='float32', quality='HQ') \
+            if pcm_sampling_rate != sampling_rate else None
+        self.__pcm_samples = 0
+        self.__samples = 0
+        # the samples not framed yet, starting with the padding of the first frame
+        self.__pending = np.zeros(self.N_FFT // 2, dtype=np.float32)
+        self.__mel_frames = []  # (n_mels, frames) arrays
+        self.__rms_frames = []
+        self.__mfccs = None
+
+    def add_pcm(self, pcm):
+        """
+        adds the next slice of the speech
+        """
+        if self.finished:
+            raise ValueError(f"{self.audio_file}: cannot add speech after finish()")
+        data = np.asarray(pcm, dtype=np.float32) / 32768.0
+        self.__pcm_samples += len(data)
+        if self.__resampler is not None:
+            data = self.__resampler.resample_chunk(data)
+        self.__samples += len(data)
+        self.__frame(data)
+        self.segments += 1
+
+    def finish(self):
+        """
+        frames the end of the speech, to be called once all the slices have been added
+        """
+        if self.finished:
+            return self
+        pending = self.__pending
+        if self.__resampler is not None:
+            pending = np.concatenate([pending, self.__resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)])
+        samples = self.__samples + len(pending) - len(self.__pending)
+        # librosa.resample fixes the length of the output to the one of the ratio
+        target = int(np.ceil(self.__pcm_samples * self.sampling_rate / self.pcm_sampling_rate))
+        if samples > target:
+            pending = pending[:len(pending) - (samples - target)]
+        else:
+            pending = np.concatenate([pending, np.zeros(target - samples, dtype=np.float32)])
+        self.__pending, self.__samples = pending, target
+        self.finished = True
+        # the padding of the last frame
+        self.__frame(np.zeros(self.N_FFT // 2, dtype=np.float32))
+        return self
+
+    def __frame(self, data):
+        pending = np.concatenate([self.__pending, data])
+        frames = 0 if len(pending) < self.N_FFT else 1 + (len(pending) - self.N_FFT) // self.HOP_LENGTH
+        if frames > 0:
+            chunk = pending[:(frames - 1) * self.HOP_LENGTH + self.N_FFT]
+            self.__mel_frames.append(librosa.feature.melspectrogram(y=chunk, sr=self.sampling_rate, n_fft=self.N_FFT,
+                                                                    hop_length=self.HOP_LENGTH, center=False))
+            self.__rms_frames.append(librosa.feature.rms(y=chunk, frame_length=self.N_FFT, hop_length=self.HOP_LENGTH, center=False)[0])
+            self.__mfccs = None
+            pending = pending[frames * self.HOP_LENGTH:]
+        self.__pending = pending
+
+    @property
+    def duration(self):
+        """
+        seconds
+        """
+        return self.__samples / self.sampling_rate
+
+    @property
+    def mfcc_frames(self):
+        return sum(mel.shape[1] for mel in self.__mel_frames)
+
+    @property
+    def mfccs(self):
+        """
+        the 40 MFCCs averaged over time, the input of the sentiment classifier
+        """
+        if self.__mfccs is None:
+            if len(self.__mel_frames) == 0:
+                return np.zeros(40, dtype=np.float32)
+            mel = np.concatenate(self.__mel_frames, axis=1)
+            self.__mel_frames = [mel]
+            mfccs = librosa.feature.mfcc(S=librosa.power_to_db(mel), n_mfcc=40)
+            self.__mfccs = np.mean(mfccs.T, axis=0)
+        return self.__mfccs
+
+    @property
+    def non_silent_intervals(self):
+        if len(self.__rms_frames) == 0:
+            return 0
+        rms = np.concatenate(self.__rms_frames)
+        self.__rms_frames = [rms]
+        non_silent = librosa.amplitude_to_db(rms, ref=np.max, top_db=None) > -self.TOP_DB
+        return int(non_silent[0]) + int(np.count_nonzero(non_silent[1:] & ~non_silent[:-1]))
+
+    @property
+    def speech_rate(self):
+        """
+        the number of non-silent intervals per second
+        """
+        return self.non_silent_intervals / self.duration if self.duration > 0 else 0
 
 class AudioSentimentClassifier:
 
-    def __init__(self):
+    def __init__(self, num_threads = TFLITE_NUM_THREADS):
         self.model_path = os.path.join(os.path.dirname(__file__), MODEL_PATH)
+        self.num_threads = num_threads
+        # {'batch_size', 'features_ms', 'inference_ms'} of the last predict_batch() call
+        self.last_batch_timing = None
 
     def load_model(self):
       """
       Method to load the model.
       """
-      self.interpreter = tf.lite.Interpreter(model_path=self.model_path)
+      self.interpreter = tf.lite.Interpreter(model_path=self.model_path, num_threads=self.num_threads)
       self.interpreter.allocate_tensors()
+      input_details = self.interpreter.get_input_details()[0]
+      self.input_tensor_index = input_details['index']
+      self.input_dtype = input_details['dtype']
+      self.batch_size = int(input_details['shape'][0])
+      self.output_tensor_index = self.interpreter.get_output_details()[0]['index']
+
 
+    @staticmethod
+    def features(audio):
+      """
+      returns the features of the given audio, which can be a path or already an UtteranceFeatures (or RunningFeatures)
+      """
+      return UtteranceFeatures(audio) if isinstance(audio, (str, os.PathLike)) else audio
 
-    def predict(self, audio_file):
+    def predict(self, audio_file, verbose = True):
       """
       Method to process the files and create audio features.
-      audio_file: path to the audio file to be classified
+      audio_file: path to the audio file to be classified, or its UtteranceFeatures / RunningFeatures
       """
-      data, sampling_rate = librosa.load(audio_file)
-      mfccs = np.mean(librosa.feature.mfcc(y=data, sr=sampling_rate, n_mfcc=40).T, axis=0)
-      x = np.expand_dims(mfccs, axis=0)
-      x = np.expand_dims(x, axis=2) 
+      return self.predict_batch([audio_file], verbose)[0]
 
-      # get input and output tensors
-      input_tensor_index = self.interpreter.get_input_details()[0]['index']
-      output = self.interpreter.tensor(self.interpreter.get_output_details()[0]['index'])
+    def predict_batch(self, audio_files : list, verbose = True) -> list:
+      """
+      Method to classify the speeches of all the passengers with a single inference.
+      The MFCCs of all the audio files are stacked into one input tensor, the interpreter input is resized to their number
+      (only when it changes) and all the predictions come from one invoke(); the timing is kept in last_batch_timing.
+      audio_files: list of paths to the audio files to be classified, or of their UtteranceFeatures / RunningFeatures
+      verbose: whether to print the timing
+      """
+      if len(audio_files) == 0:
+          return []
+
+      begin_time = time.perf_counter()
+      # (batch, n_mfcc, 1)
+      x = np.stack([self.features(audio_file).mfccs for audio_file in audio_files]).astype(self.input_dtype)[:, :, np.newaxis]
+      features_time = time.perf_counter()
+
+      if x.shape[0] != self.batch_size:
+          self.interpreter.resize_tensor_input(self.input_tensor_index, list(x.shape))
+          self.interpreter.allocate_tensors()
+          self.batch_size = x.shape[0]
 
       # run inference
-      self.interpreter.set_tensor(input_tensor_index, x)
+      self.interpreter.set_tensor(self.input_tensor_index, x)
       self.interpreter.invoke()
 
-      # get the output
-      predictions = output()[0]
-      predicted_class = np.argmax(predictions)
-      predicted_class = self.convertclasstoemotion(predicted_class)
-
-      return predicted_class
+      # get the output, one row of class probabilities per audio file
+      predictions = self.interpreter.get_tensor(self.output_tensor_index)
+      predicted_classes = [self.convertclasstoemotion(predicted_class) for predicted_class in np.argmax(predictions, axis=1)]
+      end_time = time.perf_counter()
+
+      self.last_batch_timing = {'batch_size': len(audio_files),
+                                'features_ms': round((features_time - begin_time) * 1000, 2),
+                                'inference_ms': round((end_time - features_time) * 1000, 2)}
+      if verbose:
+          print(f"Classified {len(audio_files)} speeches: features {self.last_batch_timing['features_ms']} ms, "
+                f"inference {self.last_batch_timing['inference_ms']} ms")
+      return predicted_classes
     
     sentiment_engagement_mapping = {
           'neutral': 2,
@@ -75,76 +300,27 @@ class AudioSentimentClassifier:
         Method to estimate the user engagement within the audio file. 
         The engagement score is estimated from the speech rate, audio duration and the sentiment.
         sentiment: the predicted sentiment of the audio file
-        audio_file: path to the audio file to be classified
+        audio_file: path to the audio file to be classified, or its UtteranceFeatures / RunningFeatures
       """
-      data, sampling_rate = librosa.load(audio_file)
-
-      # 1. speech rate as the ratio of non-silent frames over total frames
-      non_silent_frames = len(librosa.effects.split(data))
-      total_frames = len(data) / sampling_rate
-      speech_rate = non_silent_frames / total_frames
-
-      # 2. audio duration
-      audio = AudioSegment.from_wav(audio_file)
-      audio_duration = len(audio) / 1000.0 
-
-      # 3. mapping sentiment to engagement score
+      features = self.features(audio_file)
 
+      # mapping sentiment to engagement score, then adjusted on speech rate and audio duration
       engagement_score = self.sentiment_engagement_mapping.get(sentiment, 5)
 
-      # adjust based on audio duration
-      if audio_duration < 5:
-            engagement_score -= 1
-      elif audio_duration >= 10 and audio_duration < 15:
-            engagement_score += 1
-      elif audio_duration >= 15 and audio_duration < 20:
-            engagement_score += 2
-      elif audio_duration >= 20:
-            engagement_score += 3
-      
-      # now adjust engagement score based on speech rate and audio duration
-      engagement_score*=(speech_rate*10)
-      engagement_score = round(engagement_score,2)
-      engagement_score = max(1, min(10, engagement_score))
-
-      return engagement_score
+      return self.__adjust_engagement(engagement_score, features)
     
     def estimate_user_engagement_video_only(self, sentiment, audio_file):
       """
         Method to estimate the user engagement within the audio file. 
         The engagement score is estimated from the speech rate, audio duration and the sentiment obtained from the video.
         sentiment: the predicted sentiment of the image files
-        audio_file: path to the audio file to be classified
+        audio_file: path to the audio file to be classified, or its UtteranceFeatures / RunningFeatures
       """
-      data, sampling_rate = librosa.load(audio_file)
-
-      # 1. speech rate as the ratio of non-silent frames over total frames
-      non_silent_frames = len(librosa.effects.split(data))
-      total_frames = len(data) / sampling_rate
-      speech_rate = non_silent_frames / total_frames
-
-      # 2. audio duration
-      audio = AudioSegment.from_wav(audio_file)
-      audio_duration = len(audio) / 1000.0 
+      features = self.features(audio_file)
 
       engagement_score = self.visual_sentiment_engagement_mapping.get(sentiment, 5)
 
-      # adjust based on audio duration
-      if audio_duration < 5:
-            engagement_score -= 1
-      elif audio_duration >= 10 and audio_duration < 15:
-            engagement_score += 1
-      elif audio_duration >= 15 and audio_duration < 20:
-            engagement_score += 2
-      elif audio_duration >= 20:
-            engagement_score += 3
-      
-      # now adjust engagement score based on speech rate and audio duration
-      engagement_score*=(speech_rate*10)
-      engagement_score = round(engagement_score,2)
-      engagement_score = max(1, min(10, engagement_score))
-
-      return engagement_score
+      return self.__adjust_engagement(engagement_score, features)
     
     def estimate_user_engagement_ensemble(self, sentiment_from_audio, sentiment_from_video, audio_file):
       """
@@ -152,24 +328,24 @@ class AudioSentimentClassifier:
         The engagement score is estimated from the speech rate, audio duration, the sentiment obtained from the audio and the sentiment obtained from the video.
         sentiment_from_audio: the predicted sentiment of the audio file
         sentiment_from_video: the predicted sentiment of the image files
-        audio_file: path to the audio file to be classified
+        audio_file: path to the audio file to be classified, or its UtteranceFeatures / RunningFeatures
       """
-      data, sampling_rate = librosa.load(audio_file)
-
-      # 1. speech rate as the ratio of non-silent frames over total frames
-      non_silent_frames = len(librosa.effects.split(data))
-      total_frames = len(data) / sampling_rate
-      speech_rate = non_silent_frames / total_frames
-
-      # 2. audio duration
-      audio = AudioSegment.from_wav(audio_file)
-      audio_duration = len(audio) / 1000.0 
+      features = self.features(audio_file)
 
       engagement_score = self.visual_sentiment_engagement_mapping.get(sentiment_from_video, 5)
       engagement_score += self.sentiment_engagement_mapping.get(sentiment_from_audio, 5)
 
       engagement_score /= 2
 
+      return self.__adjust_engagement(engagement_score, features)
+
+    def __adjust_engagement(self, engagement_score, features):
+      """
+      adjusts the engagement score mapped from the sentiment on the speech rate and the duration of the audio
+      """
+      audio_duration = features.duration
+      speech_rate = features.speech_rate
+
       # adjust based on audio duration
       if audio_duration < 5:
             engagement_score -= 1
@@ -0,0 +1,137 @@
+import os
+import numpy as np
+from deepface import DeepFace
+
+DEEPFACE_MODEL_NAME = os.getenv("DEEPFACE_MODEL_NAME", "VGG-Face")
+# maximum cosine distance between a face and a reference picture to consider them the same person
+FACE_MATCH_THRESHOLD = float(os.getenv("FACE_MATCH_THRESHOLD", 0.40))
+# minimum overlap (intersection over union) between two bounding boxes of consecutive frames to consider them the same face
+TRACK_IOU_THRESHOLD = float(os.getenv("TRACK_IOU_THRESHOLD", 0.3))
+# frames a face can be missing before its track is lost
+TRACK_MAX_MISSES = int(os.getenv("TRACK_MAX_MISSES", 3))
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def boxes_iou(boxes_a, boxes_b):
+    """
+    returns the matrix of the intersection over union of each (x, y, w, h) box of boxes_a with each one of boxes_b
+    """
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)[:, np.newaxis, :]
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)[np.newaxis, :, :]
+    intersection_w = np.clip(np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    intersection_h = np.clip(np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    intersection = intersection_w * intersection_h
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+class FaceIdentityTracker:
+    """
+    recognizes the passengers in the webcam frames without searching the whole faces database at every frame:
+    - the embeddings of the reference pictures of the passengers onboard (DEEPFACE_DATABASE_PATH/<username>.jpg or
+      DEEPFACE_DATABASE_PATH/<username>/*.jpg) are computed once, when the tracker is created
+    - a face is identified comparing its embedding with all of them at once (cosine similarity)
+    - the identified faces are followed across frames matching their bounding boxes (IoU), so a face is identified
+      again only when it appears, or while it is still unknown
+    """
+
+    def __init__(self, database_path, usernames, model_name = DEEPFACE_MODEL_NAME):
+        self.model_name = model_name
+        self.usernames = frozenset(usernames)
+        self.__tracks = []  # list of {'box', 'username', 'misses'}
+        self.__labels, self.__references = self.__load_references(database_path, self.usernames)
+
+    def reset(self):
+        """
+        forgets the faces followed so far, keeping the reference embeddings: to be called at the start of each video recording
+        """
+        self.__tracks = []
+
+    def update(self, faces_boxes, faces_crops):
+        """
+        returns the username of each of the faces detected in the current frame (None if not recognized),
+        given their (x, y, w, h) bounding boxes and crops
+        """
+        usernames = [None] * len(faces_boxes)
+        matched_faces, matched_tracks = set(), set()
+        if len(faces_boxes) > 0 and len(self.__tracks) > 0:
+            iou = boxes_iou(faces_boxes, [track['box'] for track in self.__tracks])
+            # greedy assignment, the most overlapping pairs first
+            for flat_index in np.argsort(-iou, axis=None):
+                face_index, track_index = (int(index) for index in np.unravel_index(flat_index, iou.shape))
+                if iou[face_index, track_index] < TRACK_IOU_THRESHOLD:
+                    break
+                if face_index in matched_faces or track_index in matched_tracks:
+                    continue
+                matched_faces.add(face_index)
+                matched_tracks.add(track_index)
+                track = self.__tracks[track_index]
+                track['box'], track['misses'] = faces_boxes[face_index], 0
+                if track['username'] is None:
+                    track['username'] = self.identify(faces_crops[face_index])
+                usernames[face_index] = track['username']
+
+        # the tracks not seen in this frame are lost after TRACK_MAX_MISSES frames
+        tracks = []
+        for (track_index, track) in enumerate(self.__tracks):
+            if track_index not in matched_tracks:
+                track['misses'] += 1
+            if track['misses'] <= TRACK_MAX_MISSES:
+                tracks.append(track)
+        # the faces not matching any track are new ones: identified once, then followed
+        for face_index in range(len(faces_boxes)):
+            if face_index not in matched_faces:
+                usernames[face_index] = self.identify(faces_crops[face_index])
+                tracks.append({'box': faces_boxes[face_index], 'username': usernames[face_index], 'misses': 0})
+        self.__tracks = tracks
+        return usernames
+
+    def identify(self, face_crop):
+        """
+        returns the username of the passenger whose reference pictures are the most similar to the given face crop,
+        None if none is similar enough
+        """
+        if len(self.__labels) == 0:
+            return None
+        embedding = self.__embedding(face_crop, detector_backend='skip')
+        if embedding is None:
+            return None
+        similarities = self.__references @ embedding
+        best = int(np.argmax(similarities))
+        if 1 - similarities[best] > FACE_MATCH_THRESHOLD:
+            return None
+        return self.__labels[best]
+
+    def __load_references(self, database_path, usernames):
+        labels, references = [], []
+        for root, _, filenames in os.walk(database_path):
+            for filename in filenames:
+                if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                path = os.path.join(root, filename)
+                # the identity is the first component of the path inside the database, as for DeepFace.find
+                username = os.path.splitext(os.path.relpath(path, database_path).replace("\\", "/").split("/")[0])[0]
+                if username not in usernames:
+                    continue
+                embedding = self.__embedding(path)
+                if embedding is not None:
+                    labels.append(username)
+                    references.append(embedding)
+        print(f"Computed {len(references)} reference face embeddings for {len(set(labels))} passengers")
+        return labels, np.array(references, dtype=np.float32).reshape(len(references), -1)
+
+    def __embedding(self, img, detector_backend = 'opencv'):
+        """
+        returns the L2-normalized embedding of the (first) face of the given image path or BGR numpy image
+        """
+        try:
+            represented = DeepFace.represent(img, model_name=self.model_name, enforce_detection=False, detector_backend=detector_backend)
+        except Exception as e:
+            print(f"[!] Cannot compute the face embedding: {e}")
+            return None
+        if len(represented) == 0:
+            return None
+        embedding = np.asarray(represented[0]['embedding'], dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else None
@@ -1,8 +1,9 @@
 import os
-from pydub import AudioSegment
+import numpy as np
 from dotenv import load_dotenv
-from AudioSentimentClassificationModule.AudioSentimentClassifier import AudioSentimentClassifier
+from AudioSentimentClassificationModule.AudioSentimentClassifier import AudioSentimentClassifier, UtteranceFeatures
 from SpeakerRecognitionModule.SpeakerRecognizerStreaming import SpeakerRecognizerStreaming
+from FeedbackEstimationModule.StreamingFeedback import StreamingFeedback
 from NewsPlayingModule.news import News
 
 env_path = os.path.join(os.path.dirname(__file__), '..', '.env')
@@ -12,10 +13,15 @@ RECORDED_SPEECH_PATH = os.getenv("RECORDED_SPEECH_PATH")
 AUDIO_INPUT_DEVICE_INDEX = int(os.getenv("AUDIO_INPUT_DEVICE_INDEX"))
 
 USE_VIDEO = True if os.getenv("USE_VIDEO").lower() in ["true", "yes", "1"] else False
+# scores each speech slice while still listening, instead of all the speeches once listening stops
+STREAMING_FEEDBACK = True if os.getenv("STREAMING_FEEDBACK", "true").lower() in ["true", "yes", "1"] else False
 
 if USE_VIDEO:
     from deepface import DeepFace
+    from FeedbackEstimationModule.FaceIdentityTracker import FaceIdentityTracker
     DEEPFACE_DATABASE_PATH = os.path.abspath(os.getenv("DEEPFACE_DATABASE_PATH"))#os.getenv("DEEPFACE_DATABASE_PATH")
+    # the classes of the DeepFace emotion model, in the order of its outputs
+    EMOTION_LABELS = ["angry", "disgust", "fear", "happy", "sad", "surprise", "neutral"]
 
 
 class FeedbackEstimator(object):
@@ -23,12 +29,21 @@ class FeedbackEstimator(object):
     passengers_onboard = None
     audioSentimentClassifier = None
     speakerRecognizer = None
+    emotion_model = None
+    face_tracker = None
 
     def __init__(self, passenger_list):
         self.passengers_onboard = passenger_list
         self.speakerRecognizer = SpeakerRecognizerStreaming()
         self.audioSentimentClassifier = AudioSentimentClassifier()
         self.audioSentimentClassifier.load_model()
+        if STREAMING_FEEDBACK:
+            # a classifier of its own for the provisional results, scored one slice at a time on another thread
+            self.streamingSentimentClassifier = AudioSentimentClassifier()
+            self.streamingSentimentClassifier.load_model()
+        if USE_VIDEO:
+            # built once, None if the faces have to be analysed one by one
+            self.emotion_model = self.build_emotion_model()
 
     def update_passengers_list(self, passenger_list):
         """
@@ -42,7 +57,7 @@ class FeedbackEstimator(object):
         that will accomplish the task to adjust the embeddings w.r.t. the gathered feedback.
         This method performs the following actions:
         - call the start_listening() method to listen to the vocal speeches from passengers on board
-        - call the estimate_sentiment(merged_speech_paths) to extract the sentiment linked to a passenger speech
+        - predict the sentiment of the merged speech of each passenger, all in one batch
         - creates the resulting dictionary of the whole feedbacks to be returned to the server
         - call send_to_server(feedbacks_dict) to send the dictionary to the server
 
@@ -54,7 +69,7 @@ class FeedbackEstimator(object):
             # a. starts the camera recording and redirect the camera frames to deepface model
             self.start_video_recording(feedback_window=feedback_window)
             
-        merged_speech_paths = self.start_listening(feedback_window)
+        speeches_features = self.start_listening(feedback_window)
 
         if USE_VIDEO:
             visual_emotions_recognised = self.stop_video_recording()
@@ -62,20 +77,22 @@ class FeedbackEstimator(object):
             num_visual_labels = max([0] + [len(l) for l in visual_emotions_recognised.values()])
 
 
-        for audio_path in merged_speech_paths:
-            # 1. first predict audio sentiment
-            predicted_sentiment = self.audioSentimentClassifier.predict(audio_path)
+        # the features of each speech are shared by the classifier and every engagement estimate
+        usernames = list(speeches_features.keys())
+
+        # 1. first predict the audio sentiment of all the passengers at once
+        predicted_sentiments = self.audioSentimentClassifier.predict_batch(list(speeches_features.values()))
+
+        for (username, predicted_sentiment) in zip(usernames, predicted_sentiments):
+            features = speeches_features[username]
 
             # 2. estimate user engagement based on sentiment, speech rate, and audio duration
-            engagement_score = self.audioSentimentClassifier.estimate_user_engagement(predicted_sentiment, audio_path)
+            engagement_score = self.audioSentimentClassifier.estimate_user_engagement(predicted_sentiment, features)
 
-            # 3. create feedback dictionary for the current user
-            username = self.get_username_from_audio_path(audio_path)
-            
-            # 4. get audio duration
-            audio_duration = self.get_audio_duration(audio_path)
+            # 3. get audio duration
+            audio_duration = round(features.duration, 3)
 
-            # 5. create feedback dictionary for the current user
+            # 4. create feedback dictionary for the current user
             user_feedback = {
                 "username": username,
                 "predicted_sentiment": predicted_sentiment,
@@ -88,9 +105,9 @@ class FeedbackEstimator(object):
                     users_emotions = list(visual_emotions_recognised[username]) + ( ["NA"] * max(0, num_visual_labels // 2 - len(visual_emotions_recognised[username])) )
                     visual_emotion = max(set(users_emotions), key=users_emotions.count)
                     user_feedback["visual_emotion"] = visual_emotion
-                    engagement_score_video = self.audioSentimentClassifier.estimate_user_engagement_video_only(visual_emotion, audio_path)
+                    engagement_score_video = self.audioSentimentClassifier.estimate_user_engagement_video_only(visual_emotion, features)
                     user_feedback["engagement_score_video"] = engagement_score_video
-                    user_feedback["engagement_score_mixed"] = self.audioSentimentClassifier.estimate_user_engagement_ensemble(predicted_sentiment, visual_emotion, audio_path)
+                    user_feedback["engagement_score_mixed"] = self.audioSentimentClassifier.estimate_user_engagement_ensemble(predicted_sentiment, visual_emotion, features)
 
             feedbacks_dict["users-feeback"].append(user_feedback)
 
@@ -99,91 +116,49 @@ class FeedbackEstimator(object):
         #    print(f"returning feedback_dict which is: ", feedbacks_dict)
         return feedbacks_dict
     
-    def get_audio_duration(self, audio_path):
-        """
-        Get the duration of the audio file in seconds.
-
-        audio_path: path to the audio file
-        """
-        audio = AudioSegment.from_wav(audio_path)
-        duration_in_seconds = len(audio) / 1000.0  # ms to s
-        return duration_in_seconds
-
-    
-    def get_username_from_audio_path(self, audio_path):
-        """
-            Method to extract the username from the audio path
-            Example: "Client\speaker_profiles\enrico_speech.pv" -> "enrico"
-        """
-        file_name = os.path.basename(audio_path)
-        username = file_name.split("_")[0]
-        return username
-
-
     def start_listening(self, feedback_window=None):
         """
             Starts the recording of the passengers' voices invoking listen() method of SpeakerRecognizerStreaming.
             The method listen() is blocking; it starts the recording and waits for the user to stop speaking.
-            While listening, it saves slices of passengers' speeches (at least 4 seconds long)
-            inside Client\\SpeakerRecognition\\resources\\audio_output
+            While listening, it keeps in memory slices of passengers' speeches (at least 4 seconds long);
+            if STREAMING_FEEDBACK each slice is also featurised and scored as soon as it ends, showing provisional results,
+            so that the features are ready when listening stops
 
-            Returns the paths of the merged speechs for each passenger
+            Returns a dictionary with, for each passenger who talked, the features of all their speech slices merged
         """
-
-        def merge_audio_slices():
-            merged_paths = []  #list to store the paths of the final merged WAV files
-            for username in self.passengers_onboard:
-                audio_slices = []
-                i = 1
-                while True:
-                    audio_path = os.path.join(os.path.dirname(__file__), RECORDED_SPEECH_PATH, f"{username}_speech_{i}.wav")
-                    if os.path.exists(audio_path):
-                        audio_slices.append(AudioSegment.from_wav(audio_path))
-                        i += 1
-                    else:
-                        break
-
-                #concatenate audio slices for the same passenger
-                if audio_slices:
-                    concatenated_audio = sum(audio_slices)
-
-                    output_dir = os.path.join(os.path.dirname(__file__), RECORDED_SPEECH_PATH)
-                    os.makedirs(output_dir, exist_ok=True)
-
-                    concatenated_path = os.path.join(output_dir, f"{username}_speech.wav")
-                    concatenated_audio.export(concatenated_path, format="wav")
-                    merged_paths.append(concatenated_path)
-
-            #print("Done merging audio slices.")
-            return merged_paths
-
         print("Listening...")
         if feedback_window:
             feedback_window.print("Listening...")
 
+        streaming_feedback = StreamingFeedback(self.streamingSentimentClassifier, feedback_window) if STREAMING_FEEDBACK else None
+
         try:
             test_input_profile_paths = [f"{username}.pv" for username in self.passengers_onboard]
-            self.speakerRecognizer.listen(
+            speech_segments = self.speakerRecognizer.listen(
                 audio_device_index=AUDIO_INPUT_DEVICE_INDEX,
                 output_audio_path=None,
                 input_profile_paths=test_input_profile_paths,
                 min_speech_duration=4,
-                feedback_window=feedback_window
+                feedback_window=feedback_window,
+                on_segment=streaming_feedback.on_segment if streaming_feedback is not None else None
             )
         except Exception as e:
             print("Something went wrong while listening: ", e)
             if feedback_window:
                 feedback_window.print("Something went wrong while listening")
-
-        #at this point, we have all the slices of all the passengers inside the audio_output folder,
-        #and we can proceed to stitch them together (in case there are more than 1 .wav from the same person)
-        try:
-            merged_paths = merge_audio_slices()
-        except Exception as e:
-            print("Something went wrong while merging audio slices: ", e)
-            return
-
-        return merged_paths
+            # the slices recognized before the error are still evaluated
+            speech_segments = self.speakerRecognizer.segments
+
+        # the features of the speech of each passenger, already computed while listening if STREAMING_FEEDBACK
+        streamed_features = streaming_feedback.finish() if streaming_feedback is not None else {}
+
+        #at this point, we have in memory all the slices of all the passengers,
+        #and we can proceed to stitch them together (in case there are more than 1 slice from the same person)
+        if speech_segments is None:
+            return {}
+        return {username: streamed_features[username] if username in streamed_features else
+                    UtteranceFeatures.from_pcm(f"{username}_speech", speech_segments.merged(username), speech_segments.sample_rate)
+                for username in self.passengers_onboard if username in speech_segments.labels()}
     
     video_processing_thread = None
     continue_video_recording = False
@@ -222,6 +197,32 @@ class FeedbackEstimator(object):
             frame_bytes = base64.b64encode(buffer)
             return frame_bytes
 
+        def face_input(face_crop, target_size=224):
+            """
+            returns the face crop as DeepFace.extract_faces gives it to its models: centered in a black square
+            (keeping its aspect ratio) resized to target_size x target_size
+            """
+            height, width = face_crop.shape[:2]
+            side = max(height, width)
+            top, left = (side - height) // 2, (side - width) // 2
+            squared = cv2.copyMakeBorder(face_crop, top, side - height - top, left, side - width - left, cv2.BORDER_CONSTANT, value=0)
+            return cv2.resize(squared, (target_size, target_size))
+
+        def analyze_emotions(faces_crops):
+            """
+            returns the dominant emotion of each of the given face crops: the crops are preprocessed as DeepFace does
+            (padded to a square, grayscale, 48x48, scaled to [0, 1]) and classified with one call to the emotion model,
+            or analysed one by one if the model could not be built
+            """
+            if len(faces_crops) == 0:
+                return []
+            if self.emotion_model is not None:
+                batch = np.stack([cv2.resize(cv2.cvtColor(face_input(face_crop), cv2.COLOR_BGR2GRAY), (48, 48)) for face_crop in faces_crops])
+                predictions = self.emotion_model.predict_on_batch((batch.astype(np.float32) / 255)[..., np.newaxis])
+                return [EMOTION_LABELS[index] for index in np.argmax(np.asarray(predictions), axis=1)]
+            return [DeepFace.analyze(face_crop, actions=['emotion'], enforce_detection=False, detector_backend='skip', silent=True)[0]['dominant_emotion']
+                    for face_crop in faces_crops]
+
         self.continue_video_recording = True
         self.gathered_frames_infos = {}
 
@@ -234,48 +235,42 @@ class FeedbackEstimator(object):
             #global last_frame, new_frame_available
             
             cap = cv2.VideoCapture(0)
+            # the reference faces of the passengers are embedded once, not searched again at every frame
+            tracker = self.get_face_tracker()
             
             while self.continue_video_recording is True:
                 iteration_begin_time = time.time()
                 ret, frame = cap.read()
                 if ret:
                     frame = frame.copy()
-                    cv2.imwrite('temp_img.jpg', frame)  # Save each frame temporarily
                     default_username = self.passengers_onboard[0]
-                    detected_faces = DeepFace.extract_faces('temp_img.jpg', enforce_detection=False)
+                    # the frame (BGR, as DeepFace expects numpy images) is analysed in memory, without temporary files
+                    detected_faces = DeepFace.extract_faces(frame, enforce_detection=False)
+                    faces_areas, faces_crops, faces_usernames = [], [], []
                     for result in detected_faces:
-                        ret = DeepFace.find(result['face'], DEEPFACE_DATABASE_PATH, enforce_detection=False)
-                        if len(ret) > 0 and len(ret[0]) > 0:
-                            try:
-                                default_username = recognised_username = (os.path.abspath(ret[0].iloc[0]['identity'])).replace(DEEPFACE_DATABASE_PATH, "").replace("\\", "/").split("/")[1].replace(".jpg", "")  #instead of index -2 index 0
-                                print(f"DEEPFACE_DATABASE_PATH", DEEPFACE_DATABASE_PATH)
-                                print(f"(ret[0].iloc[0]['identity']", ret[0].iloc[0]['identity'])
-                                print(f"os.path.abspath(ret[0].iloc[0]['identity']): ", os.path.abspath(ret[0].iloc[0]['identity']))
-                            except Exception as e:
-                                print(e)
-                                print(ret)
-                                print("len(ret)", len(ret), "len(ret[0]): ", len(ret[0]))
-                            
-                        else:
-                            #print("Using as username the default value: ", default_username)
+                        facial_area = result['facial_area']
+                        x, y, w, h = max(0, facial_area['x']), max(0, facial_area['y']), facial_area['w'], facial_area['h']
+                        face_crop = frame[y:y + h, x:x + w]
+                        if face_crop.size == 0:
+                            continue
+                        faces_areas.append((x, y, w, h))
+                        faces_crops.append(face_crop)
+
+                    # the faces already followed keep their identity, only the new (or still unknown) ones are identified
+                    for recognised_username in tracker.update(faces_areas, faces_crops):
+                        if recognised_username is None:
                             recognised_username = default_username
-                        
-                        if recognised_username not in self.passengers_onboard:
-                            print(f"[!] The recognised user: {recognised_username} is not in the list of the current passengers [!]")
-                        username = recognised_username
-                        x, y, w, h = result['facial_area'].values()
-                        
-                        cv2.imwrite('temp-img-cropped.jpg', frame[y:y + w, x:x + h])
-
-                        analyzed = DeepFace.analyze('temp-img-cropped.jpg', actions=['emotion'], enforce_detection=False)
-                        print(f"Received results from DeepFace.analyze method: ", analyzed)
-                        analyzed = analyzed[0]
+                        default_username = recognised_username
+                        faces_usernames.append(recognised_username)
+
+                    # the emotions of all the faces of the frame with one call to the emotion model
+                    for (username, (x, y, w, h), dominant_emotion) in zip(faces_usernames, faces_areas, analyze_emotions(faces_crops)):
                         if username not in self.gathered_frames_infos.keys():
                             self.gathered_frames_infos[username] = []
-                        self.gathered_frames_infos[username].append(analyzed['dominant_emotion'])
+                        self.gathered_frames_infos[username].append(dominant_emotion)
                     
                         frame = cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)  # Draw bounding box
-                        label = f"Emotion: {analyzed['dominant_emotion']}"  # Create label text
+                        label = f"Emotion: {dominant_emotion}"  # Create label text
                         frame = cv2.putText(frame, label, (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)  # Display label
                         frame = cv2.putText(frame, f'User: {username}', (x, y + h + 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)  # Display label
                     # here we can add labels to the image that is in the variable frame
@@ -298,6 +293,38 @@ class FeedbackEstimator(object):
         self.video_processing_thread.start()
         print("Started video processing thread")
 
+    def get_face_tracker(self):
+        """
+        returns the tracker of the faces of the passengers onboard, without the faces followed in the previous recordings;
+        the reference faces are embedded again only when the passengers change
+        """
+        if self.face_tracker is None or self.face_tracker.usernames != frozenset(self.passengers_onboard):
+            self.face_tracker = FaceIdentityTracker(DEEPFACE_DATABASE_PATH, self.passengers_onboard)
+        else:
+            self.face_tracker.reset()
+        return self.face_tracker
+
+    @staticmethod
+    def build_emotion_model():
+        """
+        returns the keras model behind DeepFace's emotion analysis, to classify all the faces of a frame at once;
+        None if the installed DeepFace does not expose it (the faces are then analysed one by one)
+        """
+        try:
+            try:
+                model = DeepFace.build_model("Emotion", task="facial_attribute")
+            except TypeError:
+                # the DeepFace versions before the task argument
+                model = DeepFace.build_model("Emotion")
+            # the recent versions wrap the keras model in a client class
+            model = getattr(model, "model", model)
+            if not callable(getattr(model, "predict_on_batch", None)):
+                raise TypeError(f"{type(model).__name__} is not a keras model")
+            return model
+        except Exception as e:
+            print(f"[!] Cannot build the emotion model ({e}), the faces will be analysed one by one")
+            return None
+
     def stop_video_recording(self):
         print("Setting continue video recording to false")
         self.continue_video_recording = False
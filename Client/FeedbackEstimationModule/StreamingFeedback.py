@@ -0,0 +1,82 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from AudioSentimentClassificationModule.AudioSentimentClassifier import AudioSentimentClassifier, RunningFeatures
+
+
+class StreamingFeedback:
+    """
+    scores the speech of the passengers while they are still being listened to: each speech slice, as soon as the
+    speaker recognizer emits it, is added on a worker thread to the running features of its speaker, whose sentiment
+    and engagement are estimated again and shown as provisional results in the feedback window.
+    Once finished, the running features are the ones of the merged speech of each speaker, so the final feedback is
+    computed from them without featurising the speech again.
+    The audio_sentiment_classifier should be used by this object only: its interpreter keeps a batch of one speech,
+    instead of being resized back and forth against the batch of the final feedback
+    """
+
+    def __init__(self, audio_sentiment_classifier: AudioSentimentClassifier, feedback_window=None):
+        self.audio_sentiment_classifier = audio_sentiment_classifier
+        self.feedback_window = feedback_window
+        # a single worker: the classifier interpreter can't be used by more threads at once
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="feedback-scoring")
+        self.__features = {}  # username -> RunningFeatures
+        self.__incomplete = set()  # usernames whose running features miss a slice
+        self.__provisional = {}  # username -> provisional user feedback
+        self.__lock = threading.Lock()
+        self.__finishing = False
+
+    def on_segment(self, username, pcm, sample_rate):
+        """
+        called by the speaker recognizer for each speech slice, it only queues it to the worker
+        """
+        self.__executor.submit(self.__score, username, pcm, sample_rate)
+
+    def finish(self):
+        """
+        called when listening stops: adds the slices still queued, without scoring them, and completes the running
+        features of every speaker. Returns them as {username: RunningFeatures}, without the speakers a slice of which
+        could not be added
+        """
+        self.__finishing = True
+        self.__executor.shutdown(wait=True)
+        speeches_features = {}
+        for (username, features) in self.__features.items():
+            if username in self.__incomplete:
+                continue
+            try:
+                speeches_features[username] = features.finish()
+            except Exception as e:
+                print(f"[!] Cannot add the speech of {username}: {e}")
+        return speeches_features
+
+    def __score(self, username, pcm, sample_rate):
+        try:
+            with self.__lock:
+                if username in self.__incomplete:
+                    return
+                running_features = self.__features.setdefault(username, RunningFeatures(f"{username}_speech", sample_rate))
+            running_features.add_pcm(pcm)
+        except Exception as e:
+            print(f"[!] Cannot add the speech of {username}: {e}")
+            with self.__lock:
+                self.__incomplete.add(username)
+            return
+        if self.__finishing:
+            return
+
+        try:
+            predicted_sentiment = self.audio_sentiment_classifier.predict(running_features, verbose=False)
+            engagement_score = self.audio_sentiment_classifier.estimate_user_engagement(predicted_sentiment, running_features)
+            with self.__lock:
+                self.__provisional[username] = {
+                    "username": username,
+                    "predicted_sentiment": predicted_sentiment,
+                    "engagement_score": engagement_score,
+                    "audio_duration": round(running_features.duration, 3)
+                }
+                provisional_feedback = {"users-feeback": list(self.__provisional.values())}
+            if self.feedback_window:
+                self.feedback_window.show_provisional_data(provisional_feedback)
+        except Exception as e:
+            print(f"[!] Cannot score the speech of {username}: {e}")
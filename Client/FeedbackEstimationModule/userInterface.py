@@ -1,4 +1,7 @@
 import os
+import queue
+import threading
+from collections import deque
 import PySimpleGUI as sg
 from io import StringIO
 import sys
@@ -12,6 +15,45 @@ WEBCAM_IMAGE_SIZE = (400, 300)
 WINDOW_WIDTH = 850
 WINDOW_HEIGHT = 500
 
+# times per second the feedback window shows the updates posted by the feedback gathering threads
+FEEDBACK_UI_REFRESH_RATE = float(os.getenv("FEEDBACK_UI_REFRESH_RATE", 5))
+REFRESH_TIMEOUT_MS = int(1000 / FEEDBACK_UI_REFRESH_RATE)
+OUTPUT_LINES = 12
+
+class StatusChannel:
+    """
+    thread-safe channel between the feedback gathering threads and the GUI event loop, which is the only one touching Tk.
+    The messages are queued and all shown; the updates that only matter in their latest version (the speakers scores,
+    the webcam frame, the feedback table) are coalesced, so however often they are posted the GUI redraws them
+    at most once per refresh
+    """
+
+    def __init__(self):
+        self.__messages = queue.Queue()
+        self.__latest = {}
+        self.__lock = threading.Lock()
+
+    def post_message(self, message):
+        self.__messages.put(message)
+
+    def post_latest(self, key, value):
+        with self.__lock:
+            self.__latest[key] = value
+
+    def drain(self):
+        """
+        returns the messages posted since the last call, and the latest value of each key posted meanwhile
+        """
+        messages = []
+        while True:
+            try:
+                messages.append(self.__messages.get_nowait())
+            except queue.Empty:
+                break
+        with self.__lock:
+            latest, self.__latest = self.__latest, {}
+        return messages, latest
+
 class FeedbackWindow:
     def __init__(self):
         sg.theme('Reddit')
@@ -55,6 +97,9 @@ class FeedbackWindow:
         ]
 
         self.window = sg.Window('Feedback Collection', layout, size=(WINDOW_WIDTH, WINDOW_HEIGHT), background_color='black', resizable=True, finalize=True)
+        self.status = StatusChannel()
+        self.__output_lines = deque(maxlen=OUTPUT_LINES)
+        self.__scores = ''
 
     #def capture_prints(self):
     #    sys.stdout = self.print_output
@@ -63,19 +108,44 @@ class FeedbackWindow:
     #    sys.stdout = sys.__stdout__
 
     def print(self, string):
+        """
+        can be called from any thread: the message is shown at the next refresh()
+        """
+        self.status.post_message(string)
+
+    def show_scores(self, string):
+        """
+        can be called from any thread, as often as needed: only the latest scores are shown at the next refresh()
+        """
+        self.status.post_latest('scores', string)
+
+    def refresh(self):
+        """
+        called by the event loop of the window (every REFRESH_TIMEOUT_MS at most), applies the updates posted meanwhile
+        """
         if self.is_closed():
             return
-        self.window['feedback_output'].update(value=string)
+        messages, latest = self.status.drain()
+        if 'user_data' in latest:
+            self.__display_user_data(latest['user_data'])
+        if 'webcam_image' in latest and USE_VIDEO:
+            self.window['webcam_image'].update(latest['webcam_image'])
+        if len(messages) == 0 and 'scores' not in latest:
+            return
+        for message in messages:
+            self.__output_lines.extend(line for line in message.strip('\r\n').splitlines() if line.strip())
+        self.__scores = latest.get('scores', self.__scores).strip('\r\n')
+        self.window['feedback_output'].update(value='\n'.join(list(self.__output_lines) + [self.__scores]))
     #def update_prints(self):
     #    self.window['feedback_output'].update(value=self.print_output.getvalue())
 
     def show_image(self, image_buffer):
+        """
+        can be called from any thread: only the latest image is shown at the next refresh()
+        """
         if USE_VIDEO is False:
             return
-        if self.is_closed():
-            return
-        self.window['webcam_image'].update(image_buffer)
-        pass
+        self.status.post_latest('webcam_image', image_buffer)
 
     #def update_single_line_output(self, line_length):
     #    print_output_length = len(self.print_output.getvalue())
@@ -98,14 +168,23 @@ class FeedbackWindow:
     _user_data = False
 
     def store_and_display_user_data(self, feedback_data):
-        if self.is_closed():
-            return
-        
+        """
+        can be called from any thread: the data is stored at once and displayed at the next refresh()
+        """
+        self._user_data = feedback_data
+        self.status.post_latest('user_data', feedback_data)
+
+    def show_provisional_data(self, feedback_data):
+        """
+        can be called from any thread: displays the feedback estimated so far, without storing it as the final one
+        """
+        self.status.post_latest('user_data', feedback_data)
+
+    def __display_user_data(self, feedback_data):
         for i in range(3):
             self.window[f'image_{i}'].Update(filename='')
             self.window[f'username_{i}'].Update(value='')
 
-        self._user_data = feedback_data
         # get user feedback data from dictionary
         user_feedback = feedback_data.get('users-feeback', [])
 
@@ -151,7 +230,8 @@ class FeedbackWindow:
         return bool(self._user_data)
     
     def store_feedback_for_user_index(self, user_index_in_table : int):
-        if self._user_data is None or 'users-feeback' not in self._user_data.keys():
+        # the provisional results shown while listening can't be submitted yet
+        if not self._user_data or 'users-feeback' not in self._user_data.keys():
             print("[!] Cannot store user feedback! [!]")
             print("Content of user_data: ", self._user_data)
             return
@@ -1,21 +1,36 @@
 import os
+import threading
 from dotenv import load_dotenv
-import requests
 from datetime import datetime
+from urllib.parse import urlparse
 from PIL import Image
 from io import BytesIO
 import numpy as np
 
-from bs4 import BeautifulSoup
+from NewsPlayingModule.utils.disk_cache import DiskCache
+from NewsPlayingModule.utils.thumbnail_resolver import ThumbnailResolver
+from httpSession import get_session
 
 env_path = os.path.join(os.path.dirname(__file__), '..', '.env')
 load_dotenv(env_path)
 
+SERVER_BASE_URL = os.getenv("SERVER_BASE_URL")
 CATEGORY_STD_IMG_DIR = os.getenv("CATEGORY_STD_IMG_DIR")
 CATEGORIES = os.getenv("CATEGORIES").split(',')
 COLORS=os.getenv('COLORS').split(',')
 
-VERIFY_SSL = False
+AUDIO_NEWS_DIR = "audio-news"
+NEWS_IMAGES_DIR = os.path.join(os.path.dirname(__file__), "..", CATEGORY_STD_IMG_DIR)
+# the downloaded thumbnails have their own folder, the cache never sees the category pictures
+NEWS_IMAGES_CACHE_DIR = os.path.join(NEWS_IMAGES_DIR, "cache")
+AUDIO_CACHE_MAX_MB = float(os.getenv("AUDIO_CACHE_MAX_MB", 200))
+IMAGES_CACHE_MAX_MB = float(os.getenv("IMAGES_CACHE_MAX_MB", 20))
+THUMBNAILS_MEMO_PATH = os.getenv("THUMBNAILS_MEMO_PATH", "thumbnails.json")
+
+# the downloaded audio news and images are evicted least recently used first when over budget
+audio_cache = DiskCache(AUDIO_NEWS_DIR, int(AUDIO_CACHE_MAX_MB * 1024 * 1024))
+images_cache = DiskCache(NEWS_IMAGES_CACHE_DIR, int(IMAGES_CACHE_MAX_MB * 1024 * 1024))
+thumbnail_resolver = ThumbnailResolver(THUMBNAILS_MEMO_PATH)
 
 def crop_to_dimensions(img : Image, target_width, target_height):
     width, height = img.size
@@ -33,50 +48,38 @@ class News:
     CATEGORIES = CATEGORIES
     COLORS = COLORS
     COLOR_INDEX = 0
+    # (news link, width, height) -> local path of its image, so the web page of a news is scraped only once
+    IMAGE_PATHS = {}
+    IMAGE_PATHS_LOCK = threading.Lock()
+    # local path -> lock of its download, so the player and the prefetcher never write the same file at once
+    DOWNLOAD_LOCKS = {}
+    DOWNLOAD_LOCKS_LOCK = threading.Lock()
 
-    def __init__(self, news_dict : dict, wav_download_link : str) -> None:
+    def __init__(self, news_dict : dict, wav_download_link : str, prefetching = False) -> None:
         self.news_dict = news_dict
         self.wav_link = wav_download_link
-        self.color = News.COLORS[::-1][News.COLOR_INDEX]
-        News.COLOR_INDEX = (News.COLOR_INDEX + 1) % len(News.COLORS)
+        if not prefetching:
+            self.color = News.COLORS[::-1][News.COLOR_INDEX]
+            News.COLOR_INDEX = (News.COLOR_INDEX + 1) % len(News.COLORS)
         self.__fetch_wav()
+
+    @staticmethod
+    def prefetch(news_dict : dict, wav_download_link : str):
+        """
+        downloads the audio and the image of the given news, so that the News built later for it finds them locally.
+        Called by the NewsPrefetcher threads
+        """
+        news = News(news_dict, wav_download_link, prefetching=True)
+        news.get_news_image_local_path()
         
     def get_news_image_link(self):
         """
-        TODO
+        returns the url of the thumbnail of this news, None if its web page has no large enough picture.
+        The thumbnail computed by the server is preferred, the article page is scraped only for news without it
         """
-        min_width = 200
-        min_height = 200
-        try:
-            # Fetch webpage content
-            response = requests.get(self.get_news_link(), verify=VERIFY_SSL)
-            if response.status_code == 200:
-                # Parse HTML content
-                soup = BeautifulSoup(response.content, 'html.parser')
-                
-                # Find all image tags
-                images = soup.find_all('img')
-                
-                for img in images:
-                    if img.has_attr('src'):
-                        thumbnail_url = img['src']
-                        # Fetch image content
-                        img_response = requests.get(thumbnail_url, verify=VERIFY_SSL)
-                        if img_response.status_code == 200:
-                            # Open image using PIL/Pillow
-                            img_data = BytesIO(img_response.content)
-                            img_pil = Image.open(img_data)
-                                
-                            # Check image dimensions
-                            img_width, img_height = img_pil.size
-                            if img_width >= min_width and img_height >= min_height:
-                                return thumbnail_url
-                return None
-            else:
-                return None
-        except Exception as e:
-            print(f"Error: {e}")
-            return None
+        if self.news_dict.get("thumbnail"):
+            return SERVER_BASE_URL + "/thumbnails/" + self.news_dict["thumbnail"]
+        return thumbnail_resolver.resolve(self.get_news_link())
         #import random
         #token_images_set = [
         #    "https://img.iltempo.it/images/2023/12/23/094850031-fc81569b-98ee-4004-975f-6a5dc5d34b48.jpg",
@@ -94,27 +97,44 @@ class News:
         returns the local path to the image associated with this news
         the image is in png format and is cropped to the specified width and height
         """
+        if use_category_pic is True:
+            return self.get_news_category_image()
 
+        key = (self.get_news_link(), target_width, target_height)
+        with News.IMAGE_PATHS_LOCK:
+            local_path = News.IMAGE_PATHS.get(key)
+        if local_path is None or not os.path.exists(local_path):
+            local_path = self.__download_news_image(target_width, target_height)
+            if local_path is None:
+                return None
+            with News.IMAGE_PATHS_LOCK:
+                News.IMAGE_PATHS[key] = local_path
+        # pinned as soon as it is resolved: the player pins only the images already resolved when it moves to a news
+        images_cache.pin(local_path)
+        return local_path
+
+    def __download_news_image(self, target_width, target_height):
         remote_url = self.get_news_image_link()
 
-        if remote_url is None or use_category_pic is True:
+        if remote_url is None:
             return self.get_news_category_image()
         
         filename = remote_url.split("/")[-1]
 
         filename = filename.split("?")[0]
 
-        output_path = os.path.join(os.path.dirname(__file__), "..", CATEGORY_STD_IMG_DIR, filename)
+        output_path = os.path.join(NEWS_IMAGES_CACHE_DIR, filename)
 
         if os.path.exists(output_path):
             print(f"Image already downloaded, returning local path for {filename}")
+            images_cache.touch(output_path)
             return output_path
         
         # if the image is not already present, will download it
 
         try:
             # Send a GET request to download the image
-            response = requests.get(remote_url, verify=VERIFY_SSL)
+            response = get_session().get(remote_url)
             
             if response.status_code == 200:
                 # Open the image using PIL
@@ -128,6 +148,7 @@ class News:
                 
                 # Save the image to the specified output path
                 img.save(output_path, format="png")
+                images_cache.record(output_path, remote_url)
                 
                 return output_path
             else:
@@ -171,23 +192,100 @@ class News:
     def get_wav_local_path(self):
         return self.wavlocalpath
 
+    @staticmethod
+    def cached_image_path(news_link, target_width=350, target_height=350):
+        """
+        returns the local path of the image of the given news if it was already resolved, without any network access
+        """
+        with News.IMAGE_PATHS_LOCK:
+            return News.IMAGE_PATHS.get((news_link, target_width, target_height))
+
+    @staticmethod
+    def audio_local_path(remote_url):
+        """
+        returns the path where the audio news downloaded from remote_url is stored
+        """
+        parsed_url = urlparse(remote_url)
+        filename = parsed_url.path.split("/")[-1]
+        if "format=ogg" in parsed_url.query:
+            filename = os.path.splitext(filename)[0] + ".ogg"
+        return os.path.join(AUDIO_NEWS_DIR, filename)
+
+    @staticmethod
+    def download_lock(localpath):
+        """
+        returns the (reentrant) lock of the downloads into localpath
+        """
+        with News.DOWNLOAD_LOCKS_LOCK:
+            return News.DOWNLOAD_LOCKS.setdefault(os.path.abspath(localpath), threading.RLock())
+
+    @staticmethod
+    def download_resumable(remote_url, localpath, retry_on_stale_part=True):
+        """
+        downloads remote_url into localpath through a 'localpath.part' file, which is renamed only once complete.
+        If a previous download was interrupted, only the missing bytes are requested (Range), provided that
+        the remote file is still the same one (If-Range with the ETag of the partial download).
+        Concurrent downloads into the same localpath are serialized
+        """
+        with News.download_lock(localpath):
+            News.__download_resumable(remote_url, localpath, retry_on_stale_part)
+
+    @staticmethod
+    def __download_resumable(remote_url, localpath, retry_on_stale_part):
+        part_path = localpath + ".part"
+        etag_path = part_path + ".etag"
+        headers = {}
+        if os.path.exists(part_path) and os.path.exists(etag_path):
+            with open(etag_path, "r") as f:
+                etag = f.read().strip()
+            headers["Range"] = f"bytes={os.path.getsize(part_path)}-"
+            # if the remote file changed meanwhile, the server sends it whole (200) instead of the range (206)
+            headers["If-Range"] = etag
+
+        # the byte ranges refer to the file as stored on the server, not to a compressed encoding of it
+        headers["Accept-Encoding"] = "identity"
+        with get_session().get(remote_url, headers=headers, stream=True) as response:
+            if response.status_code == 416 and retry_on_stale_part:
+                # the partial file does not match the remote one anymore: starts over
+                for path in (part_path, etag_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                return News.download_resumable(remote_url, localpath, retry_on_stale_part=False)
+            response.raise_for_status()
+
+            if response.status_code != 206:
+                etag = response.headers.get("ETag")
+                if etag is not None:
+                    with open(etag_path, "w") as f:
+                        f.write(etag)
+                elif os.path.exists(etag_path):
+                    os.remove(etag_path)
+
+            with open(part_path, "ab" if response.status_code == 206 else "wb") as output_file:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    output_file.write(chunk)
+
+        os.replace(part_path, localpath)
+        if os.path.exists(etag_path):
+            os.remove(etag_path)
+
     def __fetch_wav(self, check_for_updates=False):
         """
         downloads the updated vocal profiles for the given list of usernames.
         If a newer profile is available on the server, downloads the updated version, otherwhise keeps the local one without redownloading
         """
-        OUTPUT_DIR ="audio-news"
         remote_url = self.wav_link
-        filename = remote_url.split("/")[-1]
-        self.wavlocalpath = localpath = os.path.join(OUTPUT_DIR, filename)
+        self.wavlocalpath = localpath = News.audio_local_path(remote_url)
+        filename = os.path.basename(localpath)
 
         if os.path.exists(localpath):
+            audio_cache.touch(localpath)
 
             if not check_for_updates:
                 return 
 
             local_last_modified = os.path.getmtime(localpath)
-            response = requests.head(remote_url)
+            response = get_session().head(remote_url)
 
             if response.status_code == 200:
                 remote_last_modified = response.headers.get("Last-Modified")
@@ -200,13 +298,15 @@ class News:
         
         # if we arrive here, we have to download the updated version of the audio news
         try:		
-            response = requests.get(remote_url, verify=VERIFY_SSL)
-            
-            if response.status_code == 200:
-                os.makedirs(os.path.dirname(localpath), exist_ok=True)
-                with open(localpath, "wb") as output_file:
-                    output_file.write(response.content)
-                    print(f"Downloaded newer audio news {filename}")
+            os.makedirs(os.path.dirname(localpath), exist_ok=True)
+            with News.download_lock(localpath):
+                # the prefetcher may have completed the same download while this thread was waiting for it
+                if os.path.exists(localpath) and not check_for_updates:
+                    audio_cache.touch(localpath)
+                    return
+                News.download_resumable(remote_url, localpath)
+            audio_cache.record(localpath, remote_url)
+            print(f"Downloaded newer audio news {filename}")
         except Exception as e:
             print(e)
             print(f"An error occurred while downloading audio news {filename}")
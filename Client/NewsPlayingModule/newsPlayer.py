@@ -1,13 +1,34 @@
 import os
 from dotenv import load_dotenv
-from NewsPlayingModule.news import News
-import requests
+from NewsPlayingModule.news import News, audio_cache, images_cache
+from NewsPlayingModule.prefetcher import NewsPrefetcher
+from httpSession import get_session
 
 env_path = os.path.join(os.path.dirname(__file__), '..', '.env')
 load_dotenv(env_path)
 
 SERVER_BASE_URL = os.getenv("SERVER_BASE_URL")
-VERIFY_SSL = False
+# 'ogg' downloads the compressed version of the audio news, 'wav' the original one
+AUDIO_NEWS_FORMAT = os.getenv("AUDIO_NEWS_FORMAT", "ogg").lower()
+
+def audio_news_link(wav_file_name):
+    """
+    returns the server link of the audio news generated in the given wav file, in the AUDIO_NEWS_FORMAT format
+    """
+    link = SERVER_BASE_URL + "/audio-news/" + wav_file_name
+    if AUDIO_NEWS_FORMAT == "ogg":
+        link += "?format=ogg"
+    return link
+
+def audio_download_link(news_dict : dict):
+    """
+    returns the link of the audio of the given news, None if it has no audio trace
+    """
+    if "Wav-link" in news_dict.keys() and news_dict["Wav-link"] != None:
+        return news_dict["Wav-link"]
+    elif "wav_file_name" in news_dict.keys() and news_dict["wav_file_name"] != None:
+        return audio_news_link(news_dict["wav_file_name"])
+    return None
 
 class NewsPlayer:
     def __init__(self, passengers_list : list, already_played_news : list = []) -> None:
@@ -16,6 +37,8 @@ class NewsPlayer:
 
         self.__already_played_news = already_played_news
         self.__news_index = -1
+        self.__current_news = None
+        self.prefetcher = NewsPrefetcher()
         pass
 
     def update_passengers_list(self, passenger_list):
@@ -54,17 +77,15 @@ class NewsPlayer:
                 #    TODO: a logic that handles when all the news were already played and fetches new news
                 continue
             
-            if "Wav-link" in news_to_play.keys() and news_to_play["Wav-link"] != None:
-                wav_download_link = news_to_play["Wav-link"]
-
-            elif "wav_file_name" in news_to_play.keys() and news_to_play["wav_file_name"] != None:
-                wav_download_link = SERVER_BASE_URL + "/audio-news/" + news_to_play["wav_file_name"]
-            else:
+            wav_download_link = audio_download_link(news_to_play)
+            if wav_download_link is None:
                 print("Skipping news without audio trace")
                 continue
             break
 
+        self.prefetcher.wait(news_to_play["Link"])
         self.__current_news = News(news_to_play, wav_download_link)
+        self.prefetch_upcoming_news()
 
         #print(f"[DEBUG]: initial: {initial}\t after the loop: {self.__news_index}")
         return self.__current_news
@@ -84,17 +105,15 @@ class NewsPlayer:
             for self.__news_index in range(self.__news_index - 1, -1, -1):
                 news_to_play = news_list[self.__news_index]
                                 
-                if "Wav-link" in news_to_play.keys() and news_to_play["Wav-link"] != None:
-                    wav_download_link = news_to_play["Wav-link"]
-
-                elif "wav_file_name" in news_to_play.keys() and news_to_play["wav_file_name"] != None:
-                    wav_download_link = SERVER_BASE_URL + "/audio-news/" + news_to_play["wav_file_name"]
-                else:
+                wav_download_link = audio_download_link(news_to_play)
+                if wav_download_link is None:
                     print("Skipping news without audio trace")
                     continue
                 break
 
+            self.prefetcher.wait(news_to_play["Link"])
             self.__current_news = News(news_to_play, wav_download_link)
+            self.prefetch_upcoming_news()
             return self.__current_news
             
         else:
@@ -102,6 +121,39 @@ class NewsPlayer:
         
     
 
+    def prefetch_upcoming_news(self):
+        """
+        starts downloading in background the news that follow the current one in the suggested list,
+        skipping the already played ones, and pins their files and the current news ones in the disk caches
+        """
+        if not hasattr(self, "cached") or self.cached is None:
+            return
+        upcoming = []
+        for news_dict in self.cached[self.__news_index + 1:]:
+            wav_download_link = audio_download_link(news_dict)
+            if wav_download_link is None or news_dict["Link"] in self.__already_played_news:
+                continue
+            upcoming.append((news_dict, wav_download_link))
+        self.prefetcher.prefetch(upcoming)
+
+        queued = [News.audio_local_path(wav_download_link) for (_, wav_download_link) in upcoming[:self.prefetcher.lookahead]]
+        queued_links = [news_dict["Link"] for (news_dict, _) in upcoming[:self.prefetcher.lookahead]]
+        if self.__current_news is not None:
+            queued.append(self.__current_news.get_wav_local_path())
+            queued_links.append(self.__current_news.get_news_link())
+        audio_cache.set_pinned(queued)
+        # the images not resolved yet are pinned by News.get_news_image_local_path() once they are
+        queued_images = [News.cached_image_path(link) for link in queued_links]
+        images_cache.set_pinned([path for path in queued_images if path is not None])
+
+    def close(self):
+        """
+        stops the prefetching and saves the access times of the cached files, to be called when the client exits
+        """
+        self.prefetcher.shutdown()
+        audio_cache.flush()
+        images_cache.flush()
+
     def add_news_to_played(self, news : News):
         """
         adds the given news to the list of already played news
@@ -122,21 +174,21 @@ class NewsPlayer:
         - Link
         - Title
         - Summary
-        - Article
-        - Date
         - Embedding
-        - Wav-link
         - wav_file_name
+        - thumbnail (the file name of the picture of the news on the server, None if it has none)
+        the full text of a news is not part of the suggestions, it can be fetched from /news_article?link=<Link>
         """
         print("Fetching news from the server...", end="")
         endpoint= SERVER_BASE_URL + f"/news_suggestion?users={';'.join(self.passengers)}"
         try:
-            response = requests.get(endpoint, verify=VERIFY_SSL)
+            response = get_session().get(endpoint)
             response.raise_for_status()
             self.cached = response.json()
             self.__news_index = -1
             self.__current_news = None
             print("Done!")
+            self.prefetch_upcoming_news()
             return self.cached
         except Exception as e:
             print(e)
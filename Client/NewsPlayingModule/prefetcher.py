@@ -0,0 +1,72 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from dotenv import load_dotenv
+
+from NewsPlayingModule.news import News
+
+env_path = os.path.join(os.path.dirname(__file__), '..', '.env')
+load_dotenv(env_path)
+
+PREFETCH_LOOKAHEAD = int(os.getenv("PREFETCH_LOOKAHEAD", 3))
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 2))
+# seconds the GUI waits for the prefetch of the news to play, if already running, before downloading it by itself
+PREFETCH_WAIT_TIMEOUT = float(os.getenv("PREFETCH_WAIT_TIMEOUT", 5))
+
+class NewsPrefetcher:
+    """
+    downloads in background, on a bounded pool of threads, the audio and the image of the news that are going to be
+    played next, so that next/previous in the player window play them from the local storage
+    without blocking the GUI event loop on the network
+    """
+
+    def __init__(self, lookahead = PREFETCH_LOOKAHEAD, max_workers = PREFETCH_WORKERS):
+        self.lookahead = lookahead
+        self.__executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="news-prefetch")
+        self.__futures = {}  # news link -> future of its prefetch, only for the current lookahead window
+        self.__lock = threading.Lock()
+
+    def prefetch(self, upcoming_news : list):
+        """
+        schedules the prefetch of the first lookahead news of the given list of (news_dict, wav_download_link),
+        skipping the ones already prefetched or being prefetched.
+        The prefetches of the news no longer in the window are cancelled if not started yet, and forgotten once done
+        """
+        window = upcoming_news[:self.lookahead]
+        window_links = {news_dict["Link"] for (news_dict, _) in window}
+        with self.__lock:
+            for link in list(self.__futures.keys()):
+                if link not in window_links and (self.__futures[link].done() or self.__futures[link].cancel()):
+                    del self.__futures[link]
+            for (news_dict, wav_download_link) in window:
+                link = news_dict["Link"]
+                future = self.__futures.get(link)
+                # a failed prefetch is retried
+                if future is not None and not (future.done() and future.exception() is not None):
+                    continue
+                self.__futures[link] = self.__executor.submit(News.prefetch, news_dict, wav_download_link)
+
+    def wait(self, link, timeout = PREFETCH_WAIT_TIMEOUT):
+        """
+        called by the GUI thread before playing the given news: if its prefetch is still queued behind the other ones
+        it is cancelled (the caller downloads the news by itself), if running it is waited for timeout seconds at most,
+        so that its files are not downloaded twice. A download still running after that is never duplicated:
+        the caller waits for it through the lock of its file (see News.download_lock)
+        """
+        with self.__lock:
+            future = self.__futures.pop(link, None)
+        if future is None or future.cancel():
+            return
+        try:
+            future.result(timeout=timeout)
+        except TimeoutError:
+            print(f"[!] Prefetch of {link} still running after {timeout} seconds, not waiting for it anymore")
+        except Exception as e:
+            print(f"[!] Prefetch of {link} failed: {e}")
+
+    def shutdown(self):
+        """
+        drops the prefetches not started yet, the running ones are completed in background
+        """
+        self.__executor.shutdown(wait=False, cancel_futures=True)
@@ -12,7 +12,7 @@ from usersManager import UsersManager
 from FeedbackEstimationModule.FeedbackEstimator import FeedbackEstimator
 
 from DataVisualizationModule.userInterface import data_visualization_window
-from FeedbackEstimationModule.userInterface import FeedbackWindow
+from FeedbackEstimationModule.userInterface import FeedbackWindow, REFRESH_TIMEOUT_MS
 
 WINDOW_WIDTH = 700
 WINDOW_HEIGHT = 580
@@ -235,9 +235,13 @@ def player_window(news_player_obj: NewsPlayer, users_manager_obj: UsersManager,
         
         if feedback_window is not None and type(feedback_window) == FeedbackWindow:
             while feedback_window.is_closed() == False:
-                event_feedback, values_feedback = feedback_window.window.read() #feedback_window.window.read(2000)
+                # wakes up REFRESH_TIMEOUT_MS at most after the last event, to show the updates of the gathering threads
+                event_feedback, values_feedback = feedback_window.window.read(timeout=REFRESH_TIMEOUT_MS)
 
-                if event_feedback == sg.WIN_CLOSED:
+                if event_feedback == sg.TIMEOUT_KEY:
+                    feedback_window.refresh()
+
+                elif event_feedback == sg.WIN_CLOSED:
                     feedback_window.close()
                     if feedback_thread and feedback_thread.is_alive():
                         feedback_estimator.stop_gathering()
@@ -257,6 +261,9 @@ def player_window(news_player_obj: NewsPlayer, users_manager_obj: UsersManager,
                     #print("Received a click on the row #" + str(clicked_row_index))
                     feedback_window.store_feedback_for_user_index(clicked_row_index)                
                     pass
+
+                if event_feedback != sg.TIMEOUT_KEY:
+                    feedback_window.refresh()
             #elif event_feedback == sg.TIMEOUT_KEY:
             #    print("feedback_window.window.read(2000) timed out")
                 
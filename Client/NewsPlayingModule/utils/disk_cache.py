@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+
+INDEX_FILENAME = ".cache_index.json"
+# a read only updates the access time in memory, the index is rewritten at most once every this many seconds
+INDEX_SAVE_INTERVAL = 30
+
+class DiskCache:
+    """
+    bounds the size of a folder of downloaded files (audio news, news images) evicting the least recently used ones.
+    A persistent index (INDEX_FILENAME inside the folder) keeps size, last access and source url of each file.
+
+    The files currently queued for playback are pinned (see set_pinned() and pin()) and never evicted.
+    Files found in the folder but missing from the index (e.g. downloaded before the cache existed) are adopted,
+    using their modification time as last access, so the folder must hold only cached files
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.__index_path = os.path.join(directory, INDEX_FILENAME)
+        self.__entries = {}  # filename -> {'size', 'last_access', 'url'}
+        self.__pinned = set()
+        self.__lock = threading.RLock()
+        self.__last_save = 0
+        self.__dirty = False
+        self.__load()
+
+    def record(self, path, url = None):
+        """
+        registers a file just written in the folder, then evicts the least recently used ones if over budget
+        """
+        filename = os.path.basename(path)
+        with self.__lock:
+            self.__entries[filename] = {'size': os.path.getsize(path), 'last_access': time.time(), 'url': url}
+            self.__evict(keep=filename)
+            self.__save()
+
+    def touch(self, path):
+        """
+        marks a cached file as just used
+        """
+        filename = os.path.basename(path)
+        with self.__lock:
+            entry = self.__entries.get(filename)
+            if entry is None:
+                if not os.path.exists(path):
+                    return
+                entry = self.__entries[filename] = {'size': os.path.getsize(path), 'last_access': 0, 'url': None}
+            entry['last_access'] = time.time()
+            self.__dirty = True
+            if time.time() - self.__last_save > INDEX_SAVE_INTERVAL:
+                self.__save()
+
+    def set_pinned(self, paths):
+        """
+        replaces the set of the files that must not be evicted (the current news and the ones queued after it)
+        """
+        with self.__lock:
+            self.__pinned = {os.path.basename(path) for path in paths if path is not None}
+
+    def pin(self, path):
+        """
+        adds a file to the pinned ones until the next set_pinned() (e.g. an image resolved after set_pinned() was called)
+        """
+        with self.__lock:
+            self.__pinned.add(os.path.basename(path))
+
+    def total_bytes(self):
+        with self.__lock:
+            return sum(entry['size'] for entry in self.__entries.values())
+
+    def flush(self):
+        """
+        writes the index if some access times changed since it was last written
+        """
+        with self.__lock:
+            if self.__dirty:
+                self.__save()
+
+    def __evict(self, keep = None):
+        """
+        removes the least recently used unpinned files until the folder fits max_bytes; has to be called holding the lock
+        """
+        total = sum(entry['size'] for entry in self.__entries.values())
+        if self.max_bytes is None or total <= self.max_bytes:
+            return
+        candidates = sorted((entry['last_access'], filename) for (filename, entry) in self.__entries.items()
+                            if filename != keep and filename not in self.__pinned)
+        for (_, filename) in candidates:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"[!] Cannot evict {filename} from {self.directory}: {e}")
+                continue
+            total -= self.__entries.pop(filename)['size']
+            print(f"Evicted {filename} from {self.directory}")
+
+    def __load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self.__index_path, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+
+        # the folder is the source of truth: forgets the deleted files, adopts the unknown ones
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename == INDEX_FILENAME or filename.endswith((".part", ".etag", ".tmp")) or not os.path.isfile(path):
+                continue
+            entry = entries.get(filename)
+            size = os.path.getsize(path)
+            if entry is None:
+                entry = {'size': size, 'last_access': os.path.getmtime(path), 'url': None}
+            entry['size'] = size
+            self.__entries[filename] = entry
+
+        with self.__lock:
+            self.__evict()
+            self.__save()
+
+    def __save(self):
+        """
+        writes the index aside and then renames it, so a crash never leaves it truncated; has to be called holding the lock
+        """
+        tmp_path = self.__index_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.__entries, f)
+            os.replace(tmp_path, self.__index_path)
+        except OSError as e:
+            print(f"[!] Cannot write the cache index of {self.directory}: {e}")
+            return
+        self.__last_save = time.time()
+        self.__dirty = False
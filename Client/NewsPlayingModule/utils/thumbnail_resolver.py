@@ -0,0 +1,149 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+from bs4 import BeautifulSoup
+from PIL import ImageFile
+
+from httpSession import get_session
+
+# metadata naming the picture the page itself chose as its preview, in order of preference
+THUMBNAIL_META = [("property", "og:image"), ("property", "og:image:secure_url"), ("name", "twitter:image"), ("name", "twitter:image:src")]
+
+class ThumbnailResolver:
+    """
+    finds the thumbnail of a news article with a single fetch of its web page:
+    1. the og:image / twitter:image metadata, if the picture is large enough
+    2. otherwise the <img> of the page, probed in parallel reading only the first bytes of each one,
+       which are enough for PIL to parse the image header and get its size; the first large enough in page order wins
+
+    The results are memoized per article link in a json file, so a page is scraped only once across sessions
+    """
+
+    def __init__(self, memo_path, min_width = 200, min_height = 200, max_workers = 4, probe_bytes = 64 * 1024, max_candidates = 20):
+        self.memo_path = memo_path
+        self.min_width = min_width
+        self.min_height = min_height
+        self.max_workers = max_workers
+        self.probe_bytes = probe_bytes
+        self.max_candidates = max_candidates
+        self.__lock = threading.Lock()
+        self.__memo = self.__load()
+
+    def resolve(self, article_link):
+        """
+        returns the url of the thumbnail of the given article, None if the page has no large enough picture
+        """
+        with self.__lock:
+            if article_link in self.__memo:
+                return self.__memo[article_link]
+
+        try:
+            response = get_session().get(article_link, timeout=(5, 15))
+            if response.status_code != 200:
+                # not memoized: the page may be reachable next time
+                return None
+            thumbnail_url = self.__find_thumbnail(article_link, response.content)
+        except Exception as e:
+            print(f"Error: {e}")
+            return None
+
+        with self.__lock:
+            self.__memo[article_link] = thumbnail_url
+            self.__save()
+        return thumbnail_url
+
+    def __find_thumbnail(self, article_link, html):
+        soup = BeautifulSoup(html, 'html.parser')
+
+        for (attribute, value) in THUMBNAIL_META:
+            meta = soup.find('meta', attrs={attribute: value})
+            if meta is None or not meta.get('content'):
+                continue
+            url = urljoin(article_link, meta['content'])
+            # og:image:width/height describe the og:image only
+            size = self.__declared_size(soup) if value.startswith('og:') else None
+            if size is None:
+                size = self.probe_size(url)
+            if self.__large_enough(size):
+                return url
+
+        candidates = []
+        for img in soup.find_all('img'):
+            src = img.get('src')
+            if not src or src.startswith('data:'):
+                continue
+            url = urljoin(article_link, src)
+            if url not in candidates:
+                candidates.append(url)
+        candidates = candidates[:self.max_candidates]
+        if len(candidates) == 0:
+            return None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.probe_size, url) for url in candidates]
+            # keeps the page order, but returns as soon as the first large enough picture is known
+            for (url, future) in zip(candidates, futures):
+                if self.__large_enough(future.result()):
+                    for pending in futures:
+                        pending.cancel()
+                    return url
+        return None
+
+    def probe_size(self, image_url):
+        """
+        returns the (width, height) of the given image reading only its first bytes, None if they can't be parsed
+        """
+        try:
+            headers = {'Range': f'bytes=0-{self.probe_bytes - 1}'}
+            with get_session().get(image_url, headers=headers, stream=True, timeout=(5, 10)) as response:
+                if response.status_code not in (200, 206):
+                    return None
+                parser = ImageFile.Parser()
+                read = 0
+                # servers ignoring Range send the whole image: stop reading anyway once the header is parsed
+                for chunk in response.iter_content(chunk_size=4096):
+                    parser.feed(chunk)
+                    if parser.image is not None:
+                        return parser.image.size
+                    read += len(chunk)
+                    if read >= self.probe_bytes:
+                        break
+        except Exception as e:
+            print(f"Cannot probe {image_url}: {e}")
+        return None
+
+    def __declared_size(self, soup):
+        """
+        returns the size of the og:image declared by the page, if any
+        """
+        width = soup.find('meta', attrs={'property': 'og:image:width'})
+        height = soup.find('meta', attrs={'property': 'og:image:height'})
+        try:
+            return int(width['content']), int(height['content'])
+        except (TypeError, KeyError, ValueError):
+            return None
+
+    def __large_enough(self, size):
+        return size is not None and size[0] >= self.min_width and size[1] >= self.min_height
+
+    def __load(self):
+        try:
+            with open(self.memo_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def __save(self):
+        """
+        has to be called holding the lock
+        """
+        tmp_path = self.memo_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.__memo, f)
+            os.replace(tmp_path, self.memo_path)
+        except OSError as e:
+            print(f"[!] Cannot write the thumbnails memo {self.memo_path}: {e}")
@@ -2,12 +2,16 @@ import contextlib
 import os
 import struct
 import sys
+import threading
 import time
 import wave
+import numpy as np
 from dotenv import load_dotenv
 from pvrecorder import PvRecorder
 import pveagle
 
+from SpeakerRecognitionModule.audioBuffers import FrameRingBuffer, SegmentBuffer
+
 env_path = os.path.join(os.path.dirname(__file__), '..', '.env')
 load_dotenv(env_path)
 
@@ -17,6 +21,13 @@ SILENCE_THRESHOLD = int(os.getenv("SILENCE_THRESHOLD"))
 MIN_SPEECH_DURATION = int(os.getenv("MIN_SPEECH_DURATION"))
 SPEECH_OUTPUT_FOLDER = os.getenv("SPEECH_OUTPUT_FOLDER")
 API_KEY = os.getenv("API_KEY")
+# also writes each speech segment to SPEECH_OUTPUT_FOLDER/{label}_speech_{n}.wav (e.g. to inspect the recordings)
+SAVE_SPEECH_SEGMENTS = (os.getenv("SAVE_SPEECH_SEGMENTS", "false").lower() in ["true", "yes", "1"])
+# seconds of audio the capture thread can be ahead of the recognition before the oldest frames are dropped
+CAPTURE_BUFFER_DURATION = float(os.getenv("CAPTURE_BUFFER_DURATION", 10))
+# longer speeches are split in segments of this many seconds
+MAX_SEGMENT_DURATION = float(os.getenv("MAX_SEGMENT_DURATION", 60))
+SCORES_PRINT_RATE = float(os.getenv("SCORES_PRINT_RATE", 5))
 
 FEEDBACK_TO_DESCRIPTIVE_MSG = {
     pveagle.EagleProfilerEnrollFeedback.AUDIO_OK: 'Good audio',
@@ -27,9 +38,66 @@ FEEDBACK_TO_DESCRIPTIVE_MSG = {
 }
 
 
+class SpeechSegments:
+    """
+    in-memory sink of the speech segments recognized while listening, as 16-bit mono PCM per speaker,
+    so that the feedback can be computed from them as soon as listening stops, without going through wav files.
+    If save_to_folder is given, every segment is also written there as {label}_speech_{n}.wav;
+    on_segment(label, pcm, sample_rate), if given, is called with each segment as soon as it is added
+    """
+
+    def __init__(self, sample_rate, save_to_folder = None, on_segment = None):
+        self.sample_rate = sample_rate
+        self.save_to_folder = save_to_folder
+        self.on_segment = on_segment
+        self.__segments = {}  # label -> list of int16 arrays
+        self.__lock = threading.Lock()
+
+    def add(self, label, pcm):
+        """
+        stores a segment of the given speaker, returns the path where it was saved, if any
+        """
+        pcm = np.asarray(pcm, dtype=np.int16)
+        with self.__lock:
+            self.__segments.setdefault(label, []).append(pcm)
+            segment_number = len(self.__segments[label])
+        if self.on_segment is not None:
+            self.on_segment(label, pcm, self.sample_rate)
+        if self.save_to_folder is None:
+            return None
+        os.makedirs(self.save_to_folder, exist_ok=True)
+        export_path = os.path.join(self.save_to_folder, f"{label}_speech_{segment_number}.wav")
+        with wave.open(export_path, 'wb') as export_file:
+            export_file.setnchannels(1)
+            export_file.setsampwidth(2)
+            export_file.setframerate(self.sample_rate)
+            export_file.writeframes(pcm.tobytes())
+        return export_path
+
+    def labels(self):
+        """
+        returns the speakers having at least a segment, in order of first speech
+        """
+        with self.__lock:
+            return list(self.__segments.keys())
+
+    def merged(self, label):
+        """
+        returns all the speech of the given speaker as one int16 array, empty if the speaker never talked
+        """
+        with self.__lock:
+            segments = list(self.__segments.get(label, []))
+        if len(segments) == 0:
+            return np.zeros(0, dtype=np.int16)
+        return np.concatenate(segments)
+
+
 class SpeakerRecognizerStreaming:
     def __init__(self):
         self.access_key = API_KEY
+        # the segments recognized by the last call to listen()
+        self.segments = None
+        self.__last_print_time = 0
 
     def read_file(self, file_name, sample_rate):
         """
@@ -57,27 +125,38 @@ class SpeakerRecognizerStreaming:
         return frames[::channels]
 
     def print_result(self, scores, labels, feedback_window):
+        """
+        called for every frame (about 30 times per second): the scores are written to stdout at most
+        SCORES_PRINT_RATE times per second, while the feedback window only keeps the latest ones until its next refresh
+        """
         result = '\rscores -> '
         result += ', '.join('`%s`: %.2f' % (label, score) for label, score in zip(labels, scores))
-        sys.stdout.write(result)
-        sys.stdout.flush()
+        now = time.monotonic()
+        if now - self.__last_print_time >= 1 / SCORES_PRINT_RATE:
+            self.__last_print_time = now
+            sys.stdout.write(result)
+            sys.stdout.flush()
         if feedback_window:
-            feedback_window.print(result)
+            feedback_window.show_scores(result)
         #feedback_window.update_single_line_output(len(result))
 
 
     def listen(self, audio_device_index, output_audio_path,
-             input_profile_paths, min_speech_duration=15, feedback_window=None):
+             input_profile_paths, min_speech_duration=15, feedback_window=None, on_segment=None):
         """
             Starts the recording of the passengers voices using the Eagle API.
-            While listening, it saves slices of passengers' speeches (at least 4 seconds long)
-            whenever the speaker stops talking.
+            While listening, it keeps in memory slices of passengers' speeches (at least 4 seconds long)
+            whenever the speaker stops talking (also saved to SPEECH_OUTPUT_FOLDER if SAVE_SPEECH_SEGMENTS).
             audio_device_index: the index of the audio device to use
             output_audio_path: the path to the output audio file
             input_profile_paths: the paths to the speaker profiles to use
             min_speech_duration: the minimum duration of a speech to be considered valid
+            on_segment: optional callback receiving (label, pcm, sample_rate) of each speech slice as soon as it ends
+
+            Returns the SpeechSegments recognized (also available as self.segments)
         """
         self._stop = False
+        self.segments = None
         profiles = list()
         speaker_labels = list()
 
@@ -87,8 +166,8 @@ class SpeakerRecognizerStreaming:
             with open(profile_path, 'rb') as f:
                 profile = pveagle.EagleProfile.from_bytes(f.read())
             profiles.append(profile)
-        speaker_counters = {label: 1 for label in speaker_labels}
 
+        eagle = None
         try:
             eagle = pveagle.create_recognizer(
                 access_key=self.access_key,
@@ -97,8 +176,14 @@ class SpeakerRecognizerStreaming:
                 speaker_profiles=profiles
             )
 
+            self.segments = SpeechSegments(eagle.sample_rate, SPEECH_OUTPUT_FOLDER if SAVE_SPEECH_SEGMENTS else None, on_segment)
+
             recorder = PvRecorder(device_index=audio_device_index, frame_length=eagle.frame_length)
+            frames_buffer = FrameRingBuffer(max(1, int(CAPTURE_BUFFER_DURATION * eagle.sample_rate / eagle.frame_length)), eagle.frame_length)
+            capture_thread = threading.Thread(target=self.__capture, args=[recorder, frames_buffer], daemon=True, name="speech-capture")
+            self.__capturing = True
             recorder.start()
+            capture_thread.start()
 
             with contextlib.ExitStack() as file_stack:
                 if output_audio_path is not None:
@@ -107,26 +192,50 @@ class SpeakerRecognizerStreaming:
                     test_audio_file.setsampwidth(2)
                     test_audio_file.setframerate(eagle.sample_rate)
 
-                start_times = {label: None for label in speaker_labels}
                 silence_duration = 0.0
+                frame_duration = eagle.frame_length / eagle.sample_rate
                 recording_active = {label: False for label in speaker_labels}
-                start_times = {label: None for label in speaker_labels}
-                speech_buffer = {label: [] for label in speaker_labels}
+                # the durations are measured in audio frames, not with the clock, as the frames may be processed late
+                start_frames = {label: None for label in speaker_labels}
+                speech_buffer = {label: SegmentBuffer(int(MAX_SEGMENT_DURATION * eagle.sample_rate)) for label in speaker_labels}
+                processed_frames = 0
+
+                def end_segment(label):
+                    duration = (processed_frames - start_frames[label]) * frame_duration
+                    if duration > min_speech_duration and speech_buffer[label].length > 0:
+                        # the sink keeps its own copy, the segment buffer is reused for the next speech
+                        export_path = self.segments.add(label, speech_buffer[label].view().copy())
+                        message = f"\nSpeaker '{label}' talked with confidence > 0.0 for {duration:.2f} seconds\n"
+                        if export_path is not None:
+                            message += f"Audio saved to: {export_path}\n"
+                        sys.stdout.write(message)
+                        sys.stdout.flush()
+                        if feedback_window:
+                            feedback_window.print(message)
+                            #feedback_window.update_prints()
+                    speech_buffer[label].clear()
 
                 try:
                     while True:
-                        pcm = recorder.read()
-                        if output_audio_path is not None:
-                            for label, active in recording_active.items():
-                                if active:
-                                    test_audio_file.writeframes(struct.pack('%dh' % len(pcm), *pcm))
+                        if self.is_stopped():
+                            print("Stopping SpeakerRecognizer due to stop request received")
+                            break
+
+                        pcm = frames_buffer.get(timeout=1)
+                        if pcm is None:
+                            if not capture_thread.is_alive():
+                                break
+                            continue
+                        processed_frames += 1
+                        if output_audio_path is not None and any(recording_active.values()):
+                            test_audio_file.writeframes(pcm.tobytes())
 
                         scores = eagle.process(pcm)
                         self.print_result(scores, speaker_labels, feedback_window)
 
                         no_speech_detected = all(confidence <= 0.0 for confidence in scores)
                         if no_speech_detected:
-                            silence_duration += eagle.frame_length / eagle.sample_rate
+                            silence_duration += frame_duration
                         else:
                             silence_duration = 0.0
 
@@ -142,38 +251,16 @@ class SpeakerRecognizerStreaming:
                             if confidence > 0.0:
                                 if not recording_active[label]:
                                     recording_active[label] = True
-                                    start_times[label] = time.time()
-                                    speech_buffer[label] = []
-                                else:
-                                    speech_buffer[label].extend(pcm)
+                                    start_frames[label] = processed_frames
+                                    speech_buffer[label].clear()
+                                elif not speech_buffer[label].append(pcm):
+                                    # the segment reached MAX_SEGMENT_DURATION: it is closed and a new one starts
+                                    end_segment(label)
+                                    start_frames[label] = processed_frames
+                                    speech_buffer[label].append(pcm)
                             elif recording_active[label]:
-                                end_time = time.time()
-                                duration = end_time - start_times[label]
-                                if duration > min_speech_duration:
-                                    output_folder = SPEECH_OUTPUT_FOLDER
-                                    if not os.path.exists(output_folder):
-                                        os.makedirs(output_folder)
-                                    export_path = f"{output_folder}/{label}_speech_{speaker_counters[label]}.wav"
-                                    with wave.open(export_path, 'wb') as export_file:
-                                        export_file.setnchannels(1)
-                                        export_file.setsampwidth(2)
-                                        export_file.setframerate(eagle.sample_rate)
-                                        export_file.writeframes(
-                                            struct.pack('%dh' % len(speech_buffer[label]), *speech_buffer[label]))
-                                    sys.stdout.write(f"\nSpeaker '{label}' talked with confidence > 0.0 for {duration:.2f} seconds\n"
-                                                    f"Audio saved to: {export_path}\n")
-                                    sys.stdout.flush()
-                                    if feedback_window:
-                                        feedback_window.print(f"\nSpeaker '{label}' talked with confidence > 0.0 for {duration:.2f} seconds\n"
-                                                    f"Audio saved to: {export_path}\n")
-                                        #feedback_window.update_prints()
-
-                                    speaker_counters[label] += 1
+                                end_segment(label)
                                 recording_active[label] = False
-                        
-                        if self.is_stopped():
-                            print("Stopping SpeakerRecognizer due to stop request received")
-                            break
 
                 except KeyboardInterrupt:
                     sys.stdout.write('\nStopping...\n')
@@ -188,12 +275,32 @@ class SpeakerRecognizerStreaming:
                         feedback_window.print('\nAccessKey has reached its processing limit\n')
                         #feedback_window.update_prints()
                 finally:
+                    self.__capturing = False
+                    capture_thread.join(2)
                     recorder.stop()
                     recorder.delete()
+                    if frames_buffer.dropped > 0:
+                        print(f"[!] {frames_buffer.dropped} audio frames were dropped, the recognition could not keep up with the capture")
         finally:
             if eagle is not None:
                 eagle.delete()
 
+        return self.segments
+
+    def __capture(self, recorder, frames_buffer):
+        """
+        capture thread: only moves the frames from the microphone to the ring buffer, so that a slow recognition
+        (or GUI update) never makes the recorder skip audio
+        """
+        try:
+            while self.__capturing:
+                frames_buffer.put(recorder.read())
+        except Exception as e:
+            if self.__capturing:
+                print(f"[!] Audio capture stopped: {e}")
+        finally:
+            frames_buffer.close()
+
     def stop(self):
         self._stop = True
 
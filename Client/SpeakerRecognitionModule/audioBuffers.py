@@ -0,0 +1,82 @@
+import threading
+import numpy as np
+
+
+class FrameRingBuffer:
+    """
+    preallocated ring of int16 audio frames between the capture thread, which must never wait, and the recognition worker.
+    If the worker falls behind by more than capacity frames the oldest ones are overwritten (and counted in dropped),
+    so the memory used stays the same however long the session lasts
+    """
+
+    def __init__(self, capacity, frame_length):
+        self.capacity = capacity
+        self.frame_length = frame_length
+        self.dropped = 0
+        self.__frames = np.zeros((capacity, frame_length), dtype=np.int16)
+        self.__written = 0  # frames written since the start, the next one goes to __written % capacity
+        self.__read = 0
+        self.__closed = False
+        self.__condition = threading.Condition()
+
+    def put(self, pcm):
+        """
+        called by the capture thread for each frame read from the microphone
+        """
+        with self.__condition:
+            if self.__written - self.__read == self.capacity:
+                self.__read += 1
+                self.dropped += 1
+            self.__frames[self.__written % self.capacity] = pcm
+            self.__written += 1
+            self.__condition.notify()
+
+    def get(self, timeout = None):
+        """
+        returns the oldest frame not read yet (a copy, as its slot is going to be reused),
+        None if none arrived within timeout or the buffer was closed and fully read
+        """
+        with self.__condition:
+            while self.__written == self.__read:
+                if self.__closed or not self.__condition.wait(timeout):
+                    return None
+            frame = self.__frames[self.__read % self.capacity].copy()
+            self.__read += 1
+            return frame
+
+    def close(self):
+        """
+        called when the capture stops: the frames already buffered can still be read
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+
+class SegmentBuffer:
+    """
+    preallocated int16 buffer accumulating the frames of a speech segment, up to max_samples
+    """
+
+    def __init__(self, max_samples):
+        self.__samples = np.zeros(max_samples, dtype=np.int16)
+        self.length = 0
+
+    def append(self, frame) -> bool:
+        """
+        returns False, without appending it, if the frame does not fit anymore
+        """
+        if self.length + len(frame) > len(self.__samples):
+            return False
+        self.__samples[self.length:self.length + len(frame)] = frame
+        self.length += len(frame)
+        return True
+
+    def view(self):
+        """
+        returns the samples of the segment without copying them: valid until the next clear()
+        """
+        return self.__samples[:self.length]
+
+    def clear(self):
+        self.length = 0
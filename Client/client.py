@@ -157,3 +157,4 @@ while True:
 		player_window(news_player_obj, users_manager_obj, feedback_estimator)
 
 window.close()
+news_player_obj.close()
@@ -0,0 +1,59 @@
+import os
+import threading
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+load_dotenv()
+
+VERIFY_SSL = False
+
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", 10))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 4))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 3))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", 0.5))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 30))
+# asks the server to gzip its responses (the json of the suggestions shrinks several times)
+HTTP_GZIP = (os.getenv("HTTP_GZIP", "true").lower() in ["true", "1", "on"])
+
+class PooledSession(requests.Session):
+    """
+    requests.Session keeping the connections alive across requests, so the TLS handshake with the server is paid once,
+    with a default timeout and retries with exponential backoff of the idempotent requests.
+
+    The pool keeps up to HTTP_POOL_MAXSIZE connections per host for HTTP_POOL_CONNECTIONS hosts; when they are all busy
+    the other threads wait for one to be free instead of opening new ones.
+    If HTTP_GZIP, responses are asked gzip-compressed (requests decompresses them transparently)
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.verify = VERIFY_SSL
+        self.headers.update({'Accept-Encoding': 'gzip, deflate' if HTTP_GZIP else 'identity'})
+        retry = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR,
+                      status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET", "HEAD"],
+                      respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, pool_block=True, max_retries=retry)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        return super().request(method, url, **kwargs)
+
+__session = None
+__session_lock = threading.Lock()
+
+def get_session() -> PooledSession:
+    """
+    returns the session shared by every module (and thread) of the client
+    """
+    global __session
+    if __session is None:
+        with __session_lock:
+            if __session is None:
+                __session = PooledSession()
+    return __session
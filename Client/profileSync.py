@@ -0,0 +1,191 @@
+import base64
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+
+from dotenv import load_dotenv
+
+from httpSession import get_session
+
+load_dotenv()
+
+SERVER_BASE_URL = os.getenv("SERVER_BASE_URL")
+PROFILE_SYNC_WORKERS = int(os.getenv("PROFILE_SYNC_WORKERS", 4))
+PROFILE_SYNC_BULK = (os.getenv("PROFILE_SYNC_BULK", "true").lower() in ["true", "1", "on"])
+PROFILE_SYNC_BULK_SIZE = int(os.getenv("PROFILE_SYNC_BULK_SIZE", 64))
+
+ETAGS_FILENAME = ".etags.json"
+
+DOWNLOADED = "downloaded"
+UP_TO_DATE = "up to date"
+MISSING = "missing"
+FAILED = "failed"
+
+# outcomes of a bulk request that returned no results
+BULK_UNSUPPORTED = "bulk unsupported"
+BULK_FAILED = "bulk failed"
+
+class ProfileSync:
+    """
+    synchronizes the local copies of the speaker profiles ('username.pv') with the server.
+
+    All the profiles to check are requested at once to /speaker_profiles/bulk, sending the ETag of each local copy,
+    so that only the changed ones come back; if the server has no bulk endpoint, each profile is requested
+    concurrently with a conditional GET (If-None-Match / If-Modified-Since), answered 304 when the local copy is
+    up to date. The ETags of the local copies are kept in ETAGS_FILENAME inside the profiles folder
+    """
+
+    def __init__(self, directory, max_workers = PROFILE_SYNC_WORKERS, use_bulk = PROFILE_SYNC_BULK):
+        self.directory = directory
+        self.max_workers = max_workers
+        self.use_bulk = use_bulk
+        self.__etags_path = os.path.join(directory, ETAGS_FILENAME)
+        self.__lock = threading.Lock()
+        self.__etags = self.__load_etags()
+
+    def profile_path(self, username):
+        return os.path.join(self.directory, f"{username}.pv")
+
+    def sync(self, usernames, check_for_updates = False) -> dict:
+        """
+        downloads the profiles of the given users missing locally, and also the changed ones if check_for_updates;
+        returns username -> DOWNLOADED / UP_TO_DATE / MISSING / FAILED
+        """
+        results = {}
+        to_sync = []
+        for username in dict.fromkeys(usernames):
+            if os.path.exists(self.profile_path(username)) and not check_for_updates:
+                print(f"A local copy of the voice profile for {username} is available, skipping updates")
+                results[username] = UP_TO_DATE
+            else:
+                to_sync.append(username)
+        if len(to_sync) == 0:
+            return results
+
+        os.makedirs(self.directory, exist_ok=True)
+        if self.use_bulk:
+            for start in range(0, len(to_sync), PROFILE_SYNC_BULK_SIZE):
+                bulk_results = self.__sync_bulk(to_sync[start:start + PROFILE_SYNC_BULK_SIZE])
+                if bulk_results == BULK_UNSUPPORTED:
+                    # the server has no bulk endpoint: falls back to the single requests from now on
+                    self.use_bulk = False
+                    break
+                if bulk_results == BULK_FAILED:
+                    # a transient error (timeout, connection reset, 5xx): single requests for this sync only
+                    break
+                results.update(bulk_results)
+        pending = [username for username in to_sync if username not in results]
+        if len(pending) > 0:
+            with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+                results.update(zip(pending, executor.map(self.__sync_one, pending)))
+
+        with self.__lock:
+            self.__save_etags()
+        for (username, result) in results.items():
+            if result == MISSING:
+                print(f"[!] No voice profile on the server for {username}")
+            elif result == FAILED:
+                print(f"An error occurred while downloading voice profile for {username}")
+        return results
+
+    def __sync_bulk(self, usernames):
+        """
+        returns the results of the given users, BULK_UNSUPPORTED if the server has no bulk endpoint,
+        BULK_FAILED if the request failed otherwise
+        """
+        with self.__lock:
+            local_etags = {username: self.__local_etag(username) for username in usernames}
+        try:
+            response = get_session().post(SERVER_BASE_URL + "/speaker_profiles/bulk", json={'profiles': local_etags})
+            if response.status_code in (404, 405):
+                return BULK_UNSUPPORTED
+            response.raise_for_status()
+            body = response.json()
+        except Exception as e:
+            print(f"[!] Bulk download of the voice profiles failed: {e}")
+            return BULK_FAILED
+
+        results = {}
+        for username in body.get("not_modified", []):
+            print(f"The local version of voice profile for {username} does not need an update")
+            results[username] = UP_TO_DATE
+        for username in body.get("missing", []):
+            results[username] = MISSING
+        for (username, profile) in body.get("profiles", {}).items():
+            try:
+                self.__write(username, base64.b64decode(profile["data"]), profile.get("etag"))
+                results[username] = DOWNLOADED
+            except Exception as e:
+                print(e)
+                results[username] = FAILED
+        return results
+
+    def __sync_one(self, username):
+        profile_path = self.profile_path(username)
+        headers = {}
+        with self.__lock:
+            etag = self.__local_etag(username)
+        if etag is not None:
+            headers["If-None-Match"] = f'"{etag}"'
+        elif os.path.exists(profile_path):
+            headers["If-Modified-Since"] = formatdate(os.path.getmtime(profile_path), usegmt=True)
+
+        try:
+            response = get_session().get(SERVER_BASE_URL + f"/speaker_profiles/{username}.pv", headers=headers)
+            if response.status_code == 304:
+                print(f"The local version of voice profile for {username} does not need an update")
+                return UP_TO_DATE
+            if response.status_code == 404:
+                return MISSING
+            response.raise_for_status()
+            self.__write(username, response.content, response.headers.get("ETag"))
+            return DOWNLOADED
+        except Exception as e:
+            print(e)
+            return FAILED
+
+    def __write(self, username, data, etag):
+        """
+        writes the profile aside and then renames it, so the speaker recognizer never reads a partial profile
+        """
+        profile_path = self.profile_path(username)
+        tmp_path = f"{profile_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as output_file:
+            output_file.write(data)
+        os.replace(tmp_path, profile_path)
+        with self.__lock:
+            if etag is not None:
+                self.__etags[username] = etag.strip('"')
+            else:
+                self.__etags.pop(username, None)
+        print(f"Downloaded newer voice profile for user {username}")
+
+    def __local_etag(self, username):
+        """
+        returns the (unquoted) ETag of the local copy of the profile, None if it has none;
+        has to be called holding the lock
+        """
+        if not os.path.exists(self.profile_path(username)):
+            return None
+        return self.__etags.get(username)
+
+    def __load_etags(self):
+        try:
+            with open(self.__etags_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def __save_etags(self):
+        """
+        has to be called holding the lock
+        """
+        tmp_path = self.__etags_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.__etags, f)
+            os.replace(tmp_path, self.__etags_path)
+        except OSError as e:
+            print(f"[!] Cannot write the voice profiles ETags {self.__etags_path}: {e}")
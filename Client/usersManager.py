@@ -1,19 +1,19 @@
 from dotenv import load_dotenv
 import requests
 import os
-from datetime import datetime
 from user import User
+from httpSession import get_session
+from profileSync import ProfileSync
 
 load_dotenv()
 
 VOCAL_PROFILES_OUTPUT_DIR = os.getenv("VOCAL_PROFILES_OUTPUT_DIR")
 SERVER_BASE_URL = os.getenv("SERVER_BASE_URL")
 
-VERIFY_SSL = False
-
 class UsersManager:
 
     users_cached = None
+    profile_sync = ProfileSync(VOCAL_PROFILES_OUTPUT_DIR)
 
     def __init__(self, passengers_onboard : list[str]) -> None:
         self.set_passengers_list(passengers_onboard)
@@ -55,7 +55,7 @@ class UsersManager:
             return UsersManager.users_cached
         url = SERVER_BASE_URL + "/users"
         try:
-            response = requests.get(url, verify=VERIFY_SSL)
+            response = get_session().get(url)
             response.raise_for_status()  # Raise an exception for HTTP errors (4xx, 5xx)
             users_data = response.json()
             UsersManager.users_cached = users_data
@@ -67,45 +67,11 @@ class UsersManager:
 
     def download_vocal_profiles(self, list_of_usernames : list = [], check_for_updates=False):
         """
-        downloads the updated vocal profiles for the given list of usernames.
-        If a newer profile is available on the server, downloads the updated version, otherwhise keeps the local one without redownloading
+        downloads the missing vocal profiles for the given list of usernames, all at once.
+        If check_for_updates, the local profiles are also checked against the server (conditional requests):
+        only the ones changed on the server are downloaded again
         """
-        SERVER_ENDPOINT = SERVER_BASE_URL + "/speaker_profiles/"
-
         if list_of_usernames is None or len(list_of_usernames) == 0:
             list_of_usernames = self.PASSENGERS_ONBOARD
 
-        for username in list_of_usernames:
-            filename = f"{username}.pv"
-            localpath = os.path.join(VOCAL_PROFILES_OUTPUT_DIR, filename)
-            remote_url = SERVER_ENDPOINT + filename
-            if os.path.exists(localpath):
-
-                if check_for_updates is False:
-                    print(f"A local copy of the voice profile for {username} is available, skipping updates")
-                    continue
-
-                local_last_modified = os.path.getmtime(localpath)
-                response = requests.head(remote_url)
-
-                if response.status_code == 200:
-                    remote_last_modified = response.headers.get("Last-Modified")
-
-                    if remote_last_modified:
-                        remote_last_modified = float(datetime.strptime(remote_last_modified, "%a, %d %b %Y %H:%M:%S %Z").timestamp())
-                        if remote_last_modified <= local_last_modified:
-                            print(f"The local version of voice profile for {username} does not need an update")
-                            continue
-            
-            # if we arrive here, we have to download the updated version of voice profile
-            try:		
-                response = requests.get(remote_url, verify=VERIFY_SSL)
-                
-                if response.status_code == 200:
-                    os.makedirs(os.path.dirname(localpath), exist_ok=True)
-                    with open(localpath, "wb") as output_file:
-                        output_file.write(response.content)
-                        print(f"Downloaded newer voice profile for user {username}")
-            except Exception as e:
-                print(e)
-                print(f"An error occurred while downloading voice profile for {username}")
\ No newline at end of file
+        return UsersManager.profile_sync.sync(list_of_usernames, check_for_updates)
\ No newline at end of file
@@ -0,0 +1,175 @@
+"""
+Approximate nearest-neighbour index over the news embeddings, to avoid scoring the whole collection at every request.
+
+It is an inverted file index (IVF): the normalized embeddings are partitioned with spherical k-means,
+a query scores only the news of the nprobe partitions whose centroid is the closest to it.
+nprobe is the recall/latency knob: nprobe = number of partitions is equivalent to the exact scan.
+
+Build it offline from the collection the server loads (store or csv), then enable it with USE_ANN_INDEX:
+    python annIndex.py build [--lists N]
+Compare its recall@10 and latency against the exact scan with:
+    python annIndex.py benchmark [--nprobe 1 2 4 8] [--synthetic N]
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+def normalize_rows(matrix : np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix, dtype=np.float32), where=norms > 0)
+
+
+class IVFIndex:
+
+    def __init__(self, centroids : np.ndarray, list_offsets : np.ndarray, list_rows : np.ndarray, collection_version : str):
+        """
+        centroids: the (num_lists, dim) normalized centroids of the partitions
+        list_offsets, list_rows: the rows of the partition i are list_rows[list_offsets[i]:list_offsets[i + 1]]
+        collection_version: the version of the collection the index was built on
+        """
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.collection_version = collection_version
+        self.num_rows = len(list_rows)
+
+    @staticmethod
+    def build(embeddings : np.ndarray, collection_version : str, num_lists = None, iterations = 20, seed = 0):
+        """
+        partitions the normalized embeddings in num_lists clusters (sqrt of the number of news by default)
+        with spherical k-means
+        """
+        data = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        num_rows = len(data)
+        if num_lists is None:
+            num_lists = int(round(np.sqrt(num_rows)))
+        num_lists = max(1, min(num_lists, num_rows))
+
+        rng = np.random.default_rng(seed)
+        centroids = data[rng.choice(num_rows, num_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = np.argmax(data @ centroids.T, axis=1)
+            counts = np.bincount(assignment, minlength=num_lists)
+            sums = np.stack([np.bincount(assignment, weights=data[:, d], minlength=num_lists) for d in range(data.shape[1])], axis=1)
+            empty = counts == 0
+            centroids[~empty] = normalize_rows(sums[~empty].astype(np.float32))
+            # empty partitions are re-seeded with random news
+            centroids[empty] = data[rng.choice(num_rows, empty.sum())]
+
+        assignment = np.argmax(data @ centroids.T, axis=1)
+        list_rows = np.argsort(assignment, kind="stable").astype(np.int64)
+        list_offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=num_lists), out=list_offsets[1:])
+        return IVFIndex(centroids, list_offsets, list_rows, collection_version)
+
+    def candidates(self, queries : np.ndarray, nprobe, num_rows, by_centroid = False) -> np.ndarray:
+        """
+        returns the sorted positions of the news to be scored for the given users embeddings (one per row).
+        by_centroid: probe the partitions closest to the mean of the queries (for centroid retrieval),
+                     otherwise the union of the partitions closest to each query (for scores averaging)
+        num_rows: the current size of the collection; the news appended after the index was built are always candidates
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if by_centroid:
+            queries = queries.mean(axis=0, keepdims=True)
+        nprobe = max(1, min(nprobe, len(self.centroids)))
+
+        centroid_scores = normalize_rows(queries) @ self.centroids.T
+        probed = np.unique(np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe])
+
+        rows = [self.list_rows[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probed]
+        if num_rows > self.num_rows:
+            rows.append(np.arange(self.num_rows, num_rows, dtype=np.int64))
+        return np.sort(np.concatenate(rows))
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, list_offsets=self.list_offsets, list_rows=self.list_rows,
+                 collection_version=np.array(self.collection_version))
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            return IVFIndex(data["centroids"], data["list_offsets"], data["list_rows"], str(data["collection_version"]))
+
+
+def benchmark(embeddings : np.ndarray, index : IVFIndex, users : np.ndarray, nprobes, num_queries = 200, k = 10, seed = 0):
+    """
+    prints recall@k and mean latency of the index against the exact scan, for groups of 1 to 4 users
+    sampled from the given users embeddings, probing both by centroid and by each user
+    """
+    rng = np.random.default_rng(seed)
+    groups = [users[rng.choice(len(users), rng.integers(1, min(4, len(users)) + 1), replace=False)] for _ in range(num_queries)]
+
+    def top_k(scores, rows):
+        k_ = min(k, len(scores))
+        return set(rows[np.argpartition(-scores, k_ - 1)[:k_]])
+
+    all_rows = np.arange(len(embeddings))
+    exact, start = [], time.perf_counter()
+    for group in groups:
+        exact.append(top_k((embeddings @ group.T).mean(axis=1), all_rows))
+    exact_latency = (time.perf_counter() - start) / num_queries
+
+    print(f"{len(embeddings)} news, {len(index.centroids)} partitions, {num_queries} queries")
+    print(f"exact scan: recall@{k} 1.000, {exact_latency * 1000:.3f} ms/query")
+    for by_centroid in (False, True):
+        for nprobe in nprobes:
+            recall, scanned, start = 0.0, 0, time.perf_counter()
+            for (group, exact_top_k) in zip(groups, exact):
+                rows = index.candidates(group, nprobe, len(embeddings), by_centroid)
+                recall += len(top_k((embeddings[rows] @ group.T).mean(axis=1), rows) & exact_top_k) / len(exact_top_k)
+                scanned += len(rows)
+            latency = (time.perf_counter() - start) / num_queries
+            print(f"{'centroid' if by_centroid else 'per-user'} nprobe {nprobe:3d}: recall@{k} {recall / num_queries:.3f}, "
+                  f"{latency * 1000:.3f} ms/query, {scanned / num_queries / len(embeddings):.1%} of the news scored")
+
+
+if __name__ == '__main__':
+    from collectionManager import CollectionManager
+    from usersRegistry import UsersRegistry
+
+    parser = argparse.ArgumentParser(description="Builds or benchmarks the approximate nearest-neighbour index of the news collection")
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--out", default=os.getenv("ANN_INDEX_FILENAME", "ann_index.npz"), help="the index file (defaults to ANN_INDEX_FILENAME)")
+    parser.add_argument("--lists", type=int, default=None, help="number of partitions, defaults to sqrt of the number of news")
+    parser.add_argument("--nprobe", type=int, nargs="*", default=[1, 2, 4, 8, 16], help="values of nprobe to benchmark")
+    parser.add_argument("--queries", type=int, default=200, help="number of benchmark queries")
+    parser.add_argument("--synthetic", type=int, default=0, help="benchmark on a synthetic collection of this size, sampled around the real news")
+    args = parser.parse_args()
+
+    collection_manager = CollectionManager(os.path.join(SCRIPT_DIRECTORY, os.getenv("COLL_CSV_FILENAME")),
+                                           os.path.join(SCRIPT_DIRECTORY, os.getenv("COLL_STORE_DIRNAME", "collection_store")),
+                                           reload_interval=0)
+    snapshot = collection_manager.get_snapshot()
+    index_path = os.path.join(SCRIPT_DIRECTORY, args.out)
+
+    if args.command == "build":
+        index = IVFIndex.build(snapshot.embeddings, snapshot.base_version, args.lists)
+        index.save(index_path)
+        print(f"Built index of {len(index.centroids)} partitions over {index.num_rows} news (collection version {index.collection_version}) in {index_path}")
+
+    elif args.command == "benchmark":
+        embeddings = np.asarray(snapshot.embeddings, dtype=np.float32)
+        if args.synthetic > 0:
+            rng = np.random.default_rng(0)
+            embeddings = embeddings[rng.integers(0, len(embeddings), args.synthetic)]
+            embeddings = np.abs(embeddings + rng.normal(0, 0.1, embeddings.shape).astype(np.float32))
+            index = IVFIndex.build(embeddings, "synthetic", args.lists)
+        elif os.path.exists(index_path):
+            index = IVFIndex.load(index_path)
+        else:
+            index = IVFIndex.build(embeddings, snapshot.base_version, args.lists)
+
+        users = UsersRegistry(os.path.join(SCRIPT_DIRECTORY, os.getenv("USERS_TSV_FILENAME")))
+        users_embeddings = users.get_embeddings(users.get_usernames())
+        users_embeddings = np.array([emb for emb in users_embeddings if len(emb) == embeddings.shape[1]], dtype=np.float32)
+        if len(users_embeddings) == 0:
+            raise ValueError("No registered user has embeddings of the size of the collection ones")
+        benchmark(embeddings, index, users_embeddings, args.nprobe, args.queries)
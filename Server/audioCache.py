@@ -0,0 +1,108 @@
+"""
+On-disk cache of the audio news transcoded from the generated wav files to OGG Vorbis.
+
+Each wav is transcoded once, the first time it is requested in the compressed format, and the result is stored
+under the sha256 of the wav content (plus the bitrate), so a regenerated wav gets a new entry and the digest
+doubles as a strong ETag. OGG Vorbis is used since pygame (the client player) can't decode Opus everywhere.
+
+Transcode every generated wav in advance with:
+    python audioCache.py build
+"""
+import argparse
+import hashlib
+import os
+import threading
+
+from dotenv import load_dotenv
+from pydub import AudioSegment
+from werkzeug.security import safe_join
+
+load_dotenv()
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+class AudioTranscodeCache:
+
+    def __init__(self, source_dir, cache_dir, bitrate = "48k"):
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.bitrate = bitrate
+        self.__digests = {}  # source path -> (mtime_ns, size, sha256 of the content)
+        self.__locks = {}  # digest -> lock serializing its transcoding within the process
+        self.__lock = threading.Lock()
+
+    def get(self, filename):
+        """
+        returns the path of the OGG version of the given wav of the source directory, transcoding it if not cached yet,
+        and the content digest to be used as its ETag.
+        Raises FileNotFoundError if the wav does not exist
+        """
+        source_path = safe_join(self.source_dir, filename)
+        if source_path is None or not os.path.isfile(source_path):
+            raise FileNotFoundError(filename)
+
+        digest = f"{self.__digest(source_path)}-{self.bitrate}"
+        cached_path = os.path.join(self.cache_dir, digest + ".ogg")
+        if os.path.exists(cached_path):
+            return cached_path, digest
+
+        with self.__lock:
+            lock = self.__locks.setdefault(digest, threading.Lock())
+        with lock:
+            if not os.path.exists(cached_path):
+                self.__transcode(source_path, cached_path)
+        with self.__lock:
+            self.__locks.pop(digest, None)
+        return cached_path, digest
+
+    def build(self):
+        """
+        transcodes every wav of the source directory which is not cached yet
+        """
+        filenames = sorted(filename for filename in os.listdir(self.source_dir) if filename.lower().endswith(".wav"))
+        for filename in filenames:
+            try:
+                self.get(filename)
+            except Exception as e:
+                print(f"[!] Cannot transcode {filename}: {e}")
+        print(f"{len(filenames)} audio news transcoded in {self.cache_dir}")
+
+    def __digest(self, source_path):
+        """
+        returns the sha256 of the file content, hashed again only when the file mtime or size change
+        """
+        stat = os.stat(source_path)
+        cached = self.__digests.get(source_path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        sha256 = hashlib.sha256()
+        with open(source_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(block)
+        digest = sha256.hexdigest()
+        self.__digests[source_path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def __transcode(self, source_path, cached_path):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # written aside and then renamed, so another worker never serves a partial file
+        tmp_path = f"{cached_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            AudioSegment.from_wav(source_path).export(tmp_path, format="ogg", codec="libvorbis", bitrate=self.bitrate)
+            os.replace(tmp_path, cached_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        print(f"Transcoded {os.path.basename(source_path)}: {os.path.getsize(source_path)} -> {os.path.getsize(cached_path)} bytes")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Transcodes the generated audio news to OGG Vorbis")
+    parser.add_argument("command", choices=["build"])
+    args = parser.parse_args()
+
+    if args.command == "build":
+        AudioTranscodeCache(os.path.join(SCRIPT_DIRECTORY, "generated_audio"),
+                            os.path.join(SCRIPT_DIRECTORY, os.getenv("AUDIO_CACHE_DIRNAME", "audio_cache")),
+                            os.getenv("AUDIO_BITRATE", "48k")).build()
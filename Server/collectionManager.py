@@ -0,0 +1,340 @@
+import glob
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from retrievalSystem import RetrievalSystem, SegmentedEmbeddings
+from annIndex import IVFIndex
+from thumbnailStore import ThumbnailStore
+from collectionStore import CollectionStore, is_collection_store, iter_new_collection_rows, read_collection_csv, META_FILENAME
+
+# column whose values are looked up by Link in the ThumbnailStore of the snapshot (see thumbnailStore.py)
+THUMBNAIL_COLUMN = 'thumbnail'
+# columns never sent with the suggestions: when the collection is loaded from a store they are not decoded in memory,
+# take() reads them from the memory-mapped store only when explicitly requested
+LAZY_COLUMNS = ('Article',)
+
+
+class CollectionSnapshot:
+    """
+    an immutable version of the collection: the news rows, the embeddings matrix aligned with them
+    (a SegmentedEmbeddings once news are ingested) and the version of the source they were loaded from.
+    A request has to get the snapshot once and use it until it completes, so that a reload can't change it midway.
+
+    The rows are kept as a list of DataFrame segments (the loaded collection, then one segment per ingested chunk),
+    so appending news never rebuilds the whole DataFrame; rows are fetched by position with take().
+    If the collection was loaded from a store, the LAZY_COLUMNS of its rows are read from the store on demand.
+    If a ThumbnailStore is attached, take() can return the THUMBNAIL_COLUMN, the thumbnail filename of each news
+    """
+
+    def __init__(self, segments : list[pd.DataFrame], embeddings : np.ndarray, version : str, link_index : dict,
+                 base_version : str = None, embeddings_buffer : np.ndarray = None, ann_index : IVFIndex = None,
+                 store : CollectionStore = None, thumbnail_store : ThumbnailStore = None):
+        self.segments = tuple(segments)
+        self.store = store
+        self.thumbnail_store = thumbnail_store
+        if isinstance(embeddings, SegmentedEmbeddings):
+            # its segments are already read-only views
+            self.embeddings = embeddings
+        else:
+            # a read-only view: the matrix is shared by the concurrent requests, none of them may write into it
+            self.embeddings = embeddings.view()
+            self.embeddings.setflags(write=False)
+        self.version = version
+        self.base_version = base_version if base_version is not None else version
+        # the approximate nearest-neighbour index built over the first rows, None to always score every news
+        self.ann_index = ann_index
+        self.__link_index = link_index
+        self.__embeddings_buffer = embeddings_buffer
+        self.__segment_starts = np.cumsum([0] + [len(segment) for segment in self.segments[:-1]])
+
+    @staticmethod
+    def from_dataframe(collection : pd.DataFrame, embeddings : np.ndarray, version : str, store : CollectionStore = None):
+        """
+        returns the snapshot of a whole loaded collection, indexing its news by Link (the first occurrence wins).
+        store: the store the collection was read from, whose first rows are the ones of the collection
+        """
+        link_index = {}
+        if 'Link' in collection.columns:
+            for (row, link) in enumerate(collection['Link']):
+                link_index.setdefault(link, row)
+        rows = collection.drop(columns=['Embedding'], errors='ignore').reset_index(drop=True)
+        return CollectionSnapshot([rows], embeddings, version, link_index, store=store)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def links(self) -> dict:
+        """
+        returns the Link -> position index, which is shared with (and updated by) the snapshots appended to this one
+        """
+        return self.__link_index
+
+    def get_row(self, link):
+        """
+        returns the position of the news with the given Link, None if it is not in this snapshot
+        """
+        row = self.__link_index.get(link)
+        if row is None or row >= len(self):
+            return None
+        return row
+
+    def take(self, indices, columns : list[str] = None) -> pd.DataFrame:
+        """
+        returns the rows at the given positions, in the given order.
+        columns: the only columns to be returned, in this order (the unknown ones are skipped), all the in-memory ones if None
+        """
+        indices = np.asarray(indices, dtype=np.intp)
+        rows = self.__take_rows(indices)
+        if columns is None:
+            return rows
+
+        for column in columns:
+            if column in LAZY_COLUMNS and self.store is not None and column in self.store.columns:
+                # the news of the store have no value in memory, the ingested ones may have
+                in_memory = rows[column].to_list() if column in rows.columns else [None] * len(rows)
+                rows = rows.assign(**{column: [self.store.get_text(column, row) if row < len(self.store) else value
+                                               for (row, value) in zip(indices, in_memory)]})
+            elif column == THUMBNAIL_COLUMN and self.thumbnail_store is not None and 'Link' in rows.columns:
+                rows = rows.assign(**{column: [self.thumbnail_store.get(link) for link in rows['Link']]})
+        return rows[[column for column in columns if column in rows.columns]]
+
+    def __take_rows(self, indices : np.ndarray) -> pd.DataFrame:
+        if len(self.segments) == 1:
+            return self.segments[0].take(indices)
+
+        segment_ids = np.searchsorted(self.__segment_starts, indices, side='right') - 1
+        rows, positions = [], []
+        for segment_id in np.unique(segment_ids):
+            selected = np.flatnonzero(segment_ids == segment_id)
+            rows.append(self.segments[segment_id].take(indices[selected] - self.__segment_starts[segment_id]))
+            positions.append(selected)
+        if len(rows) == 0:
+            return self.segments[0].head(0)
+        rows = pd.concat(rows, ignore_index=True)
+        return rows.take(np.argsort(np.concatenate(positions), kind="stable")).reset_index(drop=True)
+
+    def append(self, rows : pd.DataFrame, rows_embeddings : np.ndarray):
+        """
+        returns a new snapshot made of this one plus the given rows, which must not be already in it.
+        The embeddings of the loaded collection (memory-mapped, if loaded from a store) are never copied: the ingested
+        ones are written in a separate buffer with spare capacity, shared with the previous snapshots, which only
+        see its first rows: appends must always be done on the latest snapshot (CollectionManager.ingest does so)
+        """
+        num_rows, num_new_rows = len(self), len(rows)
+        if num_new_rows == 0:
+            return self
+
+        base = self.embeddings.segments[0] if isinstance(self.embeddings, SegmentedEmbeddings) else self.embeddings
+        num_ingested = num_rows - len(base)
+        buffer = self.__embeddings_buffer
+        if buffer is None or num_ingested + num_new_rows > len(buffer):
+            # grows geometrically, so the copies cost amortized O(1) per appended row
+            capacity = max(2 * num_ingested, num_ingested + num_new_rows)
+            new_buffer = np.empty((capacity, base.shape[1]), dtype=np.float32)
+            if buffer is not None:
+                new_buffer[:num_ingested] = buffer[:num_ingested]
+            buffer = new_buffer
+        buffer[num_ingested:num_ingested + num_new_rows] = rows_embeddings
+        ingested = buffer[:num_ingested + num_new_rows].view()
+        ingested.setflags(write=False)
+
+        for (offset, link) in enumerate(rows['Link']):
+            self.__link_index.setdefault(link, num_rows + offset)
+
+        return CollectionSnapshot(self.segments + (rows.reset_index(drop=True),), SegmentedEmbeddings([base, ingested]),
+                                  f"{self.base_version}+{num_rows + num_new_rows}", self.__link_index,
+                                  self.base_version, buffer, self.ann_index, self.store, self.thumbnail_store)
+
+
+class CollectionManager:
+    """
+    loads the collection from its compiled store (see collectionStore.py) if it was built, otherwise from the csv,
+    and keeps watching that source: when it changes, the new snapshot is loaded on a background thread
+    and then atomically swapped in place of the current one.
+
+    The news of the csv files matching ingest_pattern (e.g. the dated crawls 'collection_*.csv') are merged
+    into the live collection as they appear, see ingest()
+
+    If ann_index_path is given, the IVFIndex saved there (see annIndex.py) is attached to the snapshots of the collection
+    version it was built on; rebuilding it triggers a reload too
+
+    If a thumbnail_store is given, the snapshots look up the thumbnails of their news in it;
+    if compute_thumbnails too, the missing thumbnails of the loaded and ingested news are computed in background
+    """
+
+    def __init__(self, csv_path, store_path, reload_interval = 30, ingest_pattern = None, ingest_chunk_size = 1000, ann_index_path = None,
+                 thumbnail_store : ThumbnailStore = None, compute_thumbnails = True):
+        self.csv_path = csv_path
+        self.store_path = store_path
+        self.ann_index_path = ann_index_path
+        self.thumbnail_store = thumbnail_store
+        self.compute_thumbnails = compute_thumbnails
+        self.reload_interval = reload_interval
+        self.ingest_pattern = ingest_pattern
+        self.ingest_chunk_size = ingest_chunk_size
+        self.__snapshot = None
+        self.__source_version = None
+        self.__ingested_files = {}
+        self.__lock = threading.Lock()
+        self.__watcher_thread = None
+
+    def get_snapshot(self) -> CollectionSnapshot:
+        """
+        returns the current snapshot of the collection, loading it on the first call
+        """
+        snapshot = self.__snapshot
+        if snapshot is not None:
+            return snapshot
+        with self.__lock:
+            if self.__snapshot is None:
+                self.__snapshot, self.__source_version = self.__load()
+            return self.__snapshot
+
+    def reload_if_changed(self) -> bool:
+        """
+        reloads the collection if its source changed since the last load, returns True if a new snapshot was swapped in.
+        In-flight requests keep using the snapshot they already got
+        """
+        if self.__current_source_version() == self.__source_version:
+            return False
+        with self.__lock:
+            source_version = self.__current_source_version()
+            if source_version == self.__source_version:
+                return False
+            try:
+                snapshot, source_version = self.__load()
+            except Exception as e:
+                print(f"[!] Cannot reload the collection, keeping version {self.__snapshot.version if self.__snapshot else None}: {e}")
+                # don't retry until the source changes again
+                self.__source_version = source_version
+                return False
+            # the swap is a single reference assignment
+            self.__snapshot, self.__source_version = snapshot, source_version
+            # the ingested files have to be merged again into the new collection
+            self.__ingested_files = {}
+        print(f"Swapped in collection version {snapshot.version} ({len(snapshot)} rows)")
+        return True
+
+    def ingest(self, csv_paths) -> int:
+        """
+        streams the given collection csvs in chunks and appends to the live collection the news whose Link
+        is not in it yet, returns the number of appended news.
+        Each chunk is swapped in as soon as it is merged, so the memory needed does not depend on the size of the files
+        """
+        self.get_snapshot()
+        num_appended = 0
+        with self.__lock:
+            snapshot = self.__snapshot
+            new_rows = iter_new_collection_rows(csv_paths, snapshot.links(), dim=snapshot.embeddings.shape[1], chunksize=self.ingest_chunk_size)
+            for (rows, rows_embeddings) in new_rows:
+                # appending registers the new links, so the next chunks are de-duplicated against them too
+                snapshot = snapshot.append(rows, rows_embeddings)
+                self.__snapshot = snapshot
+                num_appended += len(rows)
+                if self.thumbnail_store is not None and self.compute_thumbnails:
+                    self.thumbnail_store.process_in_background(rows['Link'].to_list())
+        if num_appended > 0:
+            print(f"Ingested {num_appended} new news from {len(csv_paths)} files, collection version {snapshot.version}")
+        return num_appended
+
+    def ingest_new_files(self) -> int:
+        """
+        ingests the files matching ingest_pattern that were added or modified since they were last ingested
+        """
+        if not self.ingest_pattern:
+            return 0
+        paths = sorted(glob.glob(self.ingest_pattern))
+        modified = {path: os.path.getmtime(path) for path in paths
+                    if os.path.abspath(path) != os.path.abspath(self.csv_path) and self.__ingested_files.get(path) != os.path.getmtime(path)}
+        if len(modified) == 0:
+            return 0
+        num_appended = self.ingest(list(modified.keys()))
+        self.__ingested_files.update(modified)
+        return num_appended
+
+    def start_watching(self):
+        """
+        starts the daemon thread that polls the collection source every reload_interval seconds
+        """
+        if self.reload_interval is None or self.reload_interval <= 0:
+            return
+        if self.__watcher_thread is not None and self.__watcher_thread.is_alive():
+            return
+
+        def watch():
+            # loads the first snapshot right away, so the first request doesn't pay for it
+            self.get_snapshot()
+            while True:
+                try:
+                    self.reload_if_changed()
+                    self.ingest_new_files()
+                except Exception as e:
+                    print(f"[!] Collection watcher error: {e}")
+                time.sleep(self.reload_interval)
+
+        self.__watcher_thread = threading.Thread(target=watch, daemon=True, name="collection-watcher")
+        self.__watcher_thread.start()
+
+    def __current_source_version(self):
+        """
+        identifies the current content of the source through the mtime of the store metadata (rewritten at every build)
+        or of the csv if no store was built
+        """
+        path = os.path.join(self.store_path, META_FILENAME) if is_collection_store(self.store_path) else self.csv_path
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        ann_index_mtime = None
+        if self.ann_index_path is not None and os.path.exists(self.ann_index_path):
+            ann_index_mtime = os.path.getmtime(self.ann_index_path)
+        return (path, stat.st_mtime_ns, stat.st_size, ann_index_mtime)
+
+    def __load(self):
+        snapshot, source_version = self.__load_snapshot()
+        if self.thumbnail_store is not None:
+            snapshot.thumbnail_store = self.thumbnail_store
+            if self.compute_thumbnails:
+                # only the news never processed are actually fetched
+                self.thumbnail_store.process_in_background(list(snapshot.links().keys()))
+        return snapshot, source_version
+
+    def __load_snapshot(self):
+        source_version = self.__current_source_version()
+        if is_collection_store(self.store_path):
+            store = CollectionStore(self.store_path)
+            in_memory_columns = [column for column in store.columns if column not in LAZY_COLUMNS]
+            snapshot = CollectionSnapshot.from_dataframe(store.to_dataframe(in_memory_columns), store.embeddings, store.version, store)
+            snapshot.ann_index = self.__load_ann_index(snapshot)
+            print(f"Loaded collection store {store.version} of {len(snapshot)} rows")
+            return snapshot, source_version
+
+        print(f"No collection store found in {self.store_path}, parsing {self.csv_path} (run 'python collectionStore.py build' to speed up the loading)")
+        collection = read_collection_csv(self.csv_path)
+        version = f"csv-{source_version[1] if source_version else 0}-{len(collection)}"
+        snapshot = CollectionSnapshot.from_dataframe(collection, RetrievalSystem.embeddings_matrix(collection), version)
+        snapshot.ann_index = self.__load_ann_index(snapshot)
+        print(f"Loaded dataframe of {len(collection)} rows")
+        return snapshot, source_version
+
+    def __load_ann_index(self, snapshot : CollectionSnapshot):
+        """
+        returns the saved index if it was built on the version of the given snapshot, None otherwise
+        """
+        if self.ann_index_path is None or not os.path.exists(self.ann_index_path):
+            return None
+        try:
+            index = IVFIndex.load(self.ann_index_path)
+        except Exception as e:
+            print(f"[!] Cannot load the ANN index {self.ann_index_path}: {e}")
+            return None
+        if index.collection_version != snapshot.base_version or index.num_rows > len(snapshot):
+            print(f"[!] The ANN index was built on collection version {index.collection_version}, not on {snapshot.base_version}: "
+                  "scoring the whole collection until it is rebuilt (python annIndex.py build)")
+            return None
+        print(f"Loaded ANN index of {len(index.centroids)} partitions")
+        return index
@@ -0,0 +1,220 @@
+"""
+Compiled on-disk format of the news collection.
+
+A store is a directory containing:
+- embeddings.npy: the float32 embeddings matrix (one row per news), loaded memory-mapped so that
+  every gunicorn worker shares the same pages through the OS page cache
+- <column>.bin + <column>.offsets.npy + <column>.nulls.npy: every text column (Link, Title, Summary, Article, ...)
+  as a single utf-8 blob, with the byte offset of each row and a mask of the missing values
+- meta.json: number of rows, text columns, embeddings dimension, source csv and build version
+
+Build it from the collection csv (or from several dated snapshots, de-duplicated by Link) with:
+    python collectionStore.py build [collection.csv ...] [--out collection_store]
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+from ast import literal_eval
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from retrievalSystem import RetrievalSystem
+
+load_dotenv()
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+META_FILENAME = "meta.json"
+EMBEDDINGS_FILENAME = "embeddings.npy"
+
+def parse_embedding(x):
+    """
+    parses an 'Embedding' cell of the collection csv, returning an empty list if it is malformed
+    """
+    x = str(x)
+    if "," not in x:
+        x = x.replace(" ", ", ")
+    try:
+        return literal_eval(str(x))
+    except Exception as e:
+        print(e)
+        print("given x:" , x)
+        return []
+
+def read_collection_csv(csv_path, **kwargs):
+    """
+    reads a collection csv parsing its 'Embedding' column, extra kwargs are forwarded to pd.read_csv
+    """
+    conv = {'Embedding': lambda x: parse_embedding(x)}
+    return pd.read_csv(csv_path, converters=conv, index_col=0, **kwargs)
+
+def iter_new_collection_rows(csv_paths, known_links, dim = None, chunksize = 1000):
+    """
+    streams the given collection csvs in chunks of at most chunksize rows, so that the memory used does not depend
+    on the size of the files, and yields for each chunk the pair (rows, embeddings matrix) of the news
+    whose Link is not in known_links (the 'Embedding' column is dropped from the rows).
+    The caller has to add the yielded links to known_links before asking for the next chunk.
+
+    dim: the size of the embeddings of the collection being merged into, rows with a different size are skipped.
+         If None, it is taken from the first chunk
+    """
+    for csv_path in csv_paths:
+        for chunk in read_collection_csv(csv_path, chunksize=chunksize):
+            chunk = chunk.drop_duplicates('Link')
+            chunk = chunk[~chunk['Link'].map(lambda link: link in known_links)]
+            if len(chunk) == 0:
+                continue
+
+            sizes = chunk['Embedding'].map(len)
+            if dim is None:
+                dim = int(sizes.max())
+            if (sizes != dim).any():
+                print(f"[!] Skipping {(sizes != dim).sum()} rows of {os.path.basename(csv_path)} whose embedding size is not {dim}")
+                chunk = chunk[sizes == dim]
+                if len(chunk) == 0:
+                    continue
+
+            embeddings = RetrievalSystem.embeddings_matrix(chunk, dim)
+            yield chunk.drop(columns=['Embedding']).reset_index(drop=True), embeddings
+
+def is_collection_store(store_dir):
+    return store_dir is not None and os.path.exists(os.path.join(store_dir, META_FILENAME))
+
+def write_collection_store(collection : pd.DataFrame, store_dir, source=None, embeddings : np.ndarray = None):
+    """
+    writes the given collection as a store inside store_dir.
+    The store is first written in a sibling temporary directory and then moved in place,
+    so a reader never sees a partially written store
+    """
+    if embeddings is None:
+        embeddings = RetrievalSystem.embeddings_matrix(collection)
+
+    store_dir = os.path.abspath(store_dir)
+    tmp_dir = store_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    np.save(os.path.join(tmp_dir, EMBEDDINGS_FILENAME), np.ascontiguousarray(embeddings, dtype=np.float32))
+
+    text_columns = [column for column in collection.columns if column not in ('Embedding', 'score')]
+    for column in text_columns:
+        values = collection[column].to_list()
+        nulls = np.array([pd.isna(value) for value in values], dtype=bool)
+        encoded = [b"" if null else str(value).encode("utf-8") for (value, null) in zip(values, nulls)]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        with open(os.path.join(tmp_dir, column + ".bin"), "wb") as f:
+            f.write(b"".join(encoded))
+        np.save(os.path.join(tmp_dir, column + ".offsets.npy"), offsets)
+        np.save(os.path.join(tmp_dir, column + ".nulls.npy"), nulls)
+
+    meta = {
+        "num_rows": len(collection),
+        "dimension": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+        "columns": text_columns,
+        "source": source,
+        "version": time.strftime("%Y%m%d%H%M%S") + f"-{len(collection)}",
+    }
+    with open(os.path.join(tmp_dir, META_FILENAME), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    # swap the new store in place of the old one; readers that already mmapped the old files keep them alive
+    old_dir = store_dir + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(store_dir):
+        os.replace(store_dir, old_dir)
+    os.replace(tmp_dir, store_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    return meta
+
+def build_collection_store(csv_paths, store_dir, chunksize = 1000):
+    """
+    parses the collection csvs (this is the only place where the embeddings are literal_eval'd) and writes their store.
+    News appearing in more than one csv are kept once, from the first csv they appear in
+    """
+    if isinstance(csv_paths, str):
+        csv_paths = [csv_paths]
+    rows, embeddings, known_links = [], [], set()
+    for (chunk, chunk_embeddings) in iter_new_collection_rows(csv_paths, known_links, chunksize=chunksize):
+        known_links.update(chunk['Link'])
+        rows.append(chunk)
+        embeddings.append(chunk_embeddings)
+    if len(rows) == 0:
+        raise ValueError(f"No news found in {csv_paths}")
+
+    collection = pd.concat(rows, ignore_index=True)
+    source = ",".join(os.path.basename(csv_path) for csv_path in csv_paths)
+    meta = write_collection_store(collection, store_dir, source=source, embeddings=np.concatenate(embeddings))
+    print(f"Built collection store {store_dir} of {meta['num_rows']} rows from {source}")
+    return meta
+
+
+class CollectionStore:
+    """
+    read-only view over a store written by write_collection_store().
+    The embeddings and the text blobs are memory-mapped, text values are decoded only when requested
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, META_FILENAME), "r") as f:
+            self.meta = json.load(f)
+        self.version = self.meta["version"]
+        self.columns = self.meta["columns"]
+        self.embeddings = np.load(os.path.join(store_dir, EMBEDDINGS_FILENAME), mmap_mode='r')
+
+        self.__blobs = {}
+        self.__offsets = {}
+        self.__nulls = {}
+        for column in self.columns:
+            blob_path = os.path.join(store_dir, column + ".bin")
+            # np.memmap cannot map an empty file
+            self.__blobs[column] = np.memmap(blob_path, dtype=np.uint8, mode='r') if os.path.getsize(blob_path) > 0 else np.empty(0, dtype=np.uint8)
+            self.__offsets[column] = np.load(os.path.join(store_dir, column + ".offsets.npy"), mmap_mode='r')
+            self.__nulls[column] = np.load(os.path.join(store_dir, column + ".nulls.npy"), mmap_mode='r')
+
+    def __len__(self):
+        return self.meta["num_rows"]
+
+    def get_text(self, column, row):
+        """
+        returns the value of the given text column for the given row, None if missing
+        """
+        if self.__nulls[column][row]:
+            return None
+        offsets = self.__offsets[column]
+        return self.__blobs[column][offsets[row]:offsets[row + 1]].tobytes().decode("utf-8")
+
+    def get_column(self, column):
+        blob = self.__blobs[column].tobytes() if len(self.__blobs[column]) > 0 else b""
+        offsets = self.__offsets[column]
+        nulls = self.__nulls[column]
+        return [None if nulls[row] else blob[offsets[row]:offsets[row + 1]].decode("utf-8") for row in range(len(self))]
+
+    def to_dataframe(self, columns=None):
+        """
+        returns a DataFrame with the given text columns (all of them by default).
+        The embeddings are not part of it: use the 'embeddings' attribute, whose rows are aligned with the DataFrame
+        """
+        if columns is None:
+            columns = self.columns
+        return pd.DataFrame({column: self.get_column(column) for column in columns if column in self.columns})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compiles the news collection csv into a memory-mappable store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="build the store from a collection csv")
+    build_parser.add_argument("csv", nargs="*", default=[os.getenv("COLL_CSV_FILENAME")],
+                              help="the collection csvs, merged in the given order (defaults to COLL_CSV_FILENAME)")
+    build_parser.add_argument("--out", default=os.getenv("COLL_STORE_DIRNAME", "collection_store"),
+                              help="the output store directory (defaults to COLL_STORE_DIRNAME)")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_collection_store([os.path.join(SCRIPT_DIRECTORY, csv_path) for csv_path in args.csv], os.path.join(SCRIPT_DIRECTORY, args.out))
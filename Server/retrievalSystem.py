@@ -1,83 +1,275 @@
 import pandas as pd
 import numpy as np
 import os
+import threading
 
 RETRIEVE_METHOD = os.getenv("RETRIEVE_METHOD")
 
+# per-thread scratch arrays of the scoring, see RetrievalSystem.__buffer()
+_thread_buffers = threading.local()
+
+class SegmentedEmbeddings:
+    """
+    the rows of several embeddings matrices one after the other, without copying them into a single matrix
+    (e.g. the memory-mapped store, whose pages are shared by all the workers, followed by the news ingested by this worker).
+    RetrievalSystem scores it one segment at a time
+    """
+
+    def __init__(self, segments : list[np.ndarray]):
+        self.segments = tuple(segments)
+        self.starts = np.cumsum([0] + [len(segment) for segment in self.segments])
+        self.shape = (int(self.starts[-1]), self.segments[0].shape[1])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, indices):
+        return self.take(indices)
+
+    def take(self, indices, out : np.ndarray = None) -> np.ndarray:
+        """
+        returns the rows at the given positions, in the given order, in out if given
+        """
+        indices = np.asarray(indices, dtype=np.intp)
+        if out is None:
+            out = np.empty((len(indices), self.shape[1]), dtype=np.float32)
+        segment_ids = np.searchsorted(self.starts, indices, side='right') - 1
+        for segment_id in np.unique(segment_ids):
+            selected = np.flatnonzero(segment_ids == segment_id)
+            out[selected] = self.segments[segment_id][indices[selected] - self.starts[segment_id]]
+        return out
+
+    def matmul(self, other : np.ndarray, out : np.ndarray) -> np.ndarray:
+        """
+        writes in out the product of the rows with the given matrix (or vector), one segment at a time
+        """
+        for (segment, start) in zip(self.segments, self.starts):
+            np.matmul(segment, other, out=out[start:start + len(segment)])
+        return out
+
 class RetrievalSystem:
 
-    def retrieve(collection : pd.DataFrame, users_embeddings : list[list[float]], num_results = 10):
+    def embeddings_matrix(collection : pd.DataFrame, dim = None) -> np.ndarray:
+        """
+        returns the 'Embedding' column of the collection as a contiguous float32 matrix, one row per news.
+        It has to be built once when the collection is loaded and then passed to every retrieve() call;
+        rows whose embedding could not be parsed are left to zero (so they always score 0)
+
+        dim: the number of columns of the matrix, defaults to the size of the longest embedding
+        """
+        embeddings = collection['Embedding'].to_list()
+        if dim is None:
+            dim = max((len(emb) for emb in embeddings), default=0)
+        matrix = np.zeros((len(embeddings), dim), dtype=np.float32)
+        for (idx, emb) in enumerate(embeddings):
+            matrix[idx, :min(len(emb), dim)] = emb[:dim]
+        return matrix
+
+    def as_matrix(embeddings):
+        """
+        returns the embeddings as a float32 matrix, without copying them if they are already, or a SegmentedEmbeddings as is
+        """
+        if isinstance(embeddings, SegmentedEmbeddings):
+            return embeddings
+        return np.asarray(embeddings, dtype=np.float32)
+
+    def retrieve(collection : pd.DataFrame, users_embeddings : list[list[float]], num_results = 10, embeddings : np.ndarray = None,
+                 ann_index = None, nprobe = 8, fields : list[str] = None):
         """
         returns the json list of the top k suggested news
+
+        collection: a DataFrame, or a CollectionSnapshot (see collectionManager.py); rows are fetched by position through take()
+        embeddings: the matrix returned by embeddings_matrix(collection) (or a SegmentedEmbeddings), built on the fly if not given
+        ann_index: an IVFIndex (see annIndex.py) built over the embeddings; if given, only the news of the nprobe partitions
+                   closest to the passengers are scored instead of the whole collection
+        fields: the only fields of the news to be returned, see to_json()
         """
 
+        if embeddings is None:
+            embeddings = RetrievalSystem.embeddings_matrix(collection)
+
+        top_k_indices, top_k_scores = RetrievalSystem.top_k(embeddings, users_embeddings, num_results, ann_index, nprobe)
+        return RetrievalSystem.to_json(collection, top_k_indices, top_k_scores, embeddings, fields)
+
+    def top_k(embeddings : np.ndarray, users_embeddings : list[list[float]], num_results = 10, ann_index = None, nprobe = 8):
+        """
+        returns the positions of the top k suggested news, sorted by descending score, and their scores.
+        Neither the collection nor the embeddings are modified: the scores are computed in buffers owned by the calling
+        thread, so concurrent requests can share the same collection.
+        Without passengers, the first news are returned with a score of 0
+        """
         if users_embeddings is None or len(users_embeddings) == 0:
-            return collection.head(num_results).to_json(orient="records")
+            first_rows = np.arange(min(num_results, len(embeddings)))
+            return first_rows, np.zeros(len(first_rows), dtype=np.float32)
+
+        embeddings = RetrievalSystem.as_matrix(embeddings)
+        users_matrix = np.asarray(users_embeddings, dtype=np.float32)
+
+        candidates = None
+        if ann_index is not None:
+            candidates = ann_index.candidates(users_matrix, nprobe, len(embeddings), by_centroid=(RETRIEVE_METHOD == "BY_CENTROIDS"))
 
         if RETRIEVE_METHOD == "BY_CENTROIDS":
-            return RetrievalSystem.__retrieve_centroid(collection, users_embeddings, num_results)
+            scores = RetrievalSystem.__scores_centroid(embeddings, users_matrix, candidates)
         else:
-            #RetrievalSystem.__retrieve_centroid(collection, users_embeddings, num_results)
-            return RetrievalSystem.__retrieve_scores_avg(collection, users_embeddings, num_results)
+            scores = RetrievalSystem.__scores_avg(embeddings, users_matrix, candidates)
 
-    def __retrieve_centroid(collection : pd.DataFrame, users_embeddings : list[list[float]], num_results = 10):
+        top_k_indices, top_k_scores = RetrievalSystem.__top_k(scores, num_results, candidates)
+        print(f"[top_k] {RETRIEVE_METHOD} scores[:10]{top_k_scores[:10].tolist()}")
+        return top_k_indices, top_k_scores
+
+    def retrieve_batch(collection : pd.DataFrame, users_matrix : np.ndarray, groups : list[list[int]], num_results = 10,
+                       embeddings : np.ndarray = None, fields : list[str] = None) -> list[str]:
         """
-        returns the json list of the top k suggested news
-        according to the highest dot product between each news and the centroid of the representation of the users
+        returns, for each passengers group, the json list of its top k suggested news (see retrieve())
+
+        users_matrix: the embeddings of the users of all the groups, one row per distinct user
+        groups: for each group, the rows of users_matrix of its passengers
         """
-        # each row of the collection is a news, each news has 
-        # an attribute 'Embedding'
+        if embeddings is None:
+            embeddings = RetrievalSystem.embeddings_matrix(collection)
+        return [RetrievalSystem.to_json(collection, top_k_indices, top_k_scores, embeddings, fields)
+                for (top_k_indices, top_k_scores) in RetrievalSystem.top_k_batch(embeddings, users_matrix, groups, num_results)]
 
-        # each element of the list of users_embeddings contains an embedding associated with an user
+    def top_k_batch(embeddings : np.ndarray, users_matrix : np.ndarray, groups : list[list[int]], num_results = 10):
+        """
+        returns, for each passengers group, the positions of its top k suggested news and their scores (see top_k()),
+        scoring every group against the whole collection with a single matrix product.
 
-        users_mean = np.mean( np.array(users_embeddings), axis=0 )
+        Both retrieval methods score a news with the dot product between it and the mean of the embeddings of the group
+        (the average of the dot products equals the dot product with the average), so each user embedding is read once
+        however many groups share it: a (num_groups, num_users) averaging matrix turns the users into the group centroids,
+        then one (num_news, dim) x (dim, num_groups) product scores them all
+        """
+        embeddings = RetrievalSystem.as_matrix(embeddings)
+        users_matrix = np.asarray(users_matrix, dtype=np.float32).reshape(-1, embeddings.shape[1])
+        num_news = len(embeddings)
 
-        def func(row): 
-            ret = 0
-            for (idx, emb) in enumerate(row['Embedding']):
-                ret += (emb * users_mean[idx])
-            return ret
-        
-        collection['score'] = collection.apply(func, axis=1 )
-        collection.sort_values('score', ascending=False, inplace=True)
-        
-        print(f"[__retrieve_centroid] collection columns: {collection.columns}")
-        print(f"[__retrieve_centroid] df[:10]{collection['score'].head(10).to_list()}")
+        averaging = np.zeros((len(groups), len(users_matrix)), dtype=np.float32)
+        for (group_id, group) in enumerate(groups):
+            group = np.unique(np.asarray(group, dtype=np.intp))
+            if len(group) > 0:
+                averaging[group_id, group] = 1.0 / len(group)
+        centroids = averaging @ users_matrix
 
-        return collection.head(num_results).to_json(orient="records")
-    
-    def __retrieve_scores_avg(collection : pd.DataFrame, users_embeddings : list[list[float]], num_results = 10):
+        # one column of scores per group
+        scores = RetrievalSystem.__matmul(embeddings, centroids.T, RetrievalSystem.__buffer('batch_scores', (num_news, len(groups))))
+
+        num_results = min(num_results, num_news)
+        results = []
+        if num_results > 0 and len(groups) > 0:
+            # selects the top k rows of every column at once, then sorts only those
+            top_k = np.argpartition(-scores, num_results - 1, axis=0)[:num_results]
+            top_k_scores = np.take_along_axis(scores, top_k, axis=0)
+            order = np.argsort(-top_k_scores, axis=0, kind="stable")
+            top_k = np.take_along_axis(top_k, order, axis=0)
+            top_k_scores = np.take_along_axis(top_k_scores, order, axis=0)
+
+        for (group_id, group) in enumerate(groups):
+            if len(group) == 0 or num_results <= 0:
+                first_rows = np.arange(max(num_results, 0))
+                results.append((first_rows, np.zeros(len(first_rows), dtype=np.float32)))
+            else:
+                results.append((top_k[:, group_id], top_k_scores[:, group_id]))
+        print(f"[top_k_batch] {len(groups)} groups of {len(users_matrix)} distinct users scored against {num_news} news")
+        return results
+
+    def to_json(collection : pd.DataFrame, indices : np.ndarray, scores : np.ndarray, embeddings : np.ndarray, fields : list[str] = None):
         """
-        returns the json list of the top k suggested news
-        according to the highest average of the dot products between each news and each representation of the users
-        """
-        # each row of the collection is a news, each news has 
-        # an attribute 'Embedding'
-
-        # each element of the list of users_embeddings contains an embedding associated with an user
-
-        def func(row, user_embedding): 
-            ret = 0
-            for (idx, emb) in enumerate(row['Embedding']):
-                ret += (emb * user_embedding[idx])
-            return ret
-        
-        scores_series = []
-        
-        for user_emb in users_embeddings:
-            scores_series.append( collection.apply(func, args=[user_emb], axis=1 ) )
-
-        # Compute the mean along the specified axis (axis=0 for column-wise mean)
-        tmp = np.array(scores_series)
-        #print("tmp.shape: ", tmp.shape)
-        result_series = np.mean(tmp, axis=0)
-
-        #print(f"len(result_series): ", len(result_series), "how many scores_series: ", len(scores_series))
-
-        collection['score'] = result_series
-        collection.sort_values('score', ascending=False, inplace=True)
-        
-        print(f"[__retrieve_scores_avg] collection columns: {collection.columns}")
-        print(f"[__retrieve_scores_avg] df[:10]{collection['score'].head(10).to_list()}")
-
-        return collection.head(num_results).to_json(orient="records")
\ No newline at end of file
+        returns the json list of the news at the given positions, in the given order, with their 'score'.
+        Collections loaded from a store (see collectionStore.py) have no 'Embedding' column,
+        so it is filled from the rows of the embeddings matrix
+
+        fields: the only fields to be serialized, in this order (e.g. ['Link', 'Title', 'Embedding']); unknown ones are skipped.
+                All the columns of the collection plus 'score' if None
+        """
+        if fields is None:
+            rows = collection.take(indices)
+        else:
+            columns = [field for field in fields if field not in ('Embedding', 'score')]
+            if isinstance(collection, pd.DataFrame):
+                rows = collection.take(indices)[[column for column in columns if column in collection.columns]]
+            else:
+                # a CollectionSnapshot selects the columns itself, so that it can read the lazy ones from its store
+                rows = collection.take(indices, columns)
+
+        if fields is None or 'score' in fields:
+            rows = rows.assign(score=scores)
+        if (fields is None or 'Embedding' in fields) and 'Embedding' not in rows.columns:
+            rows = rows.assign(Embedding=embeddings[indices].tolist())
+        if fields is not None:
+            rows = rows[[field for field in fields if field in rows.columns]]
+        return rows.to_json(orient="records")
+
+    def __scores_centroid(embeddings : np.ndarray, users_matrix : np.ndarray, candidates : np.ndarray = None) -> np.ndarray:
+        """
+        scores each news with the dot product between it and the centroid of the representation of the users
+        """
+        # each row of the embeddings matrix is a news,
+        # each row of the users_matrix is the embedding associated with an user
+        # candidates, if given, are the positions of the only news to be scored
+        scored_embeddings = RetrievalSystem.__scored_embeddings(embeddings, candidates)
+
+        users_mean = users_matrix.mean(axis=0)
+
+        # a single matrix-vector product scores the whole collection
+        return RetrievalSystem.__matmul(scored_embeddings, users_mean, RetrievalSystem.__buffer('scores', (len(scored_embeddings),)))
+
+    def __scores_avg(embeddings : np.ndarray, users_matrix : np.ndarray, candidates : np.ndarray = None) -> np.ndarray:
+        """
+        scores each news with the average of the dot products between it and each representation of the users
+        """
+        # each row of the embeddings matrix is a news,
+        # each row of the users_matrix is the embedding associated with an user
+        # candidates, if given, are the positions of the only news to be scored
+        scored_embeddings = RetrievalSystem.__scored_embeddings(embeddings, candidates)
+        num_news, num_users = len(scored_embeddings), len(users_matrix)
+
+        # one batched matrix product scores every news against every passenger: shape (num_news, num_users)
+        scores_per_user = RetrievalSystem.__matmul(scored_embeddings, users_matrix.T, RetrievalSystem.__buffer('scores_per_user', (num_news, num_users)))
+        return np.mean(scores_per_user, axis=1, out=RetrievalSystem.__buffer('scores', (num_news,)))
+
+    def __scored_embeddings(embeddings : np.ndarray, candidates : np.ndarray = None) -> np.ndarray:
+        """
+        returns the rows of the embeddings to be scored: all of them, or the candidates ones gathered in a thread buffer
+        """
+        if candidates is None:
+            return embeddings
+        out = RetrievalSystem.__buffer('candidates', (len(candidates), embeddings.shape[1]))
+        if isinstance(embeddings, SegmentedEmbeddings):
+            return embeddings.take(candidates, out=out)
+        return np.take(embeddings, candidates, axis=0, out=out)
+
+    def __matmul(embeddings, other : np.ndarray, out : np.ndarray) -> np.ndarray:
+        """
+        writes in out the product of the embeddings (a matrix or a SegmentedEmbeddings) with the given matrix or vector
+        """
+        if isinstance(embeddings, SegmentedEmbeddings):
+            return embeddings.matmul(other, out)
+        return np.matmul(embeddings, other, out=out)
+
+    def __buffer(name, shape) -> np.ndarray:
+        """
+        returns an uninitialized float32 array of the given shape, reusing the memory the calling thread allocated
+        for the previous requests; it is only valid until the next call with the same name on the same thread
+        """
+        size = int(np.prod(shape))
+        buffer = getattr(_thread_buffers, name, None)
+        if buffer is None or len(buffer) < size:
+            buffer = np.empty(max(size, 1024), dtype=np.float32)
+            setattr(_thread_buffers, name, buffer)
+        return buffer[:size].reshape(shape)
+
+    def __top_k(scores : np.ndarray, num_results = 10, candidates : np.ndarray = None):
+        """
+        returns the positional indices of the num_results highest scores, sorted by descending score, and the scores.
+        np.argpartition selects them in linear time, so only the k selected rows are actually sorted.
+        If scores are given for the candidates rows only, the indices are mapped back to positions in the collection.
+        The returned scores are a copy, so they outlive the buffer of the scores
+        """
+        num_results = min(num_results, len(scores))
+        if num_results <= 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        top_k = np.argpartition(-scores, num_results - 1)[:num_results]
+        top_k = top_k[np.argsort(-scores[top_k], kind="stable")]
+        return (top_k if candidates is None else candidates[top_k]), scores[top_k]
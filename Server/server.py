@@ -1,19 +1,24 @@
 import struct
 import wave
-from flask import Flask, request, jsonify, render_template, Response, send_from_directory
+from flask import Flask, request, jsonify, render_template, Response, send_from_directory, send_file, abort
 import os
 from flask_cors import CORS
-import pandas as pd
 import pveagle
 from dotenv import load_dotenv
 from pydub import AudioSegment
 
-from retrievalSystem import RetrievalSystem
-
-from ast import literal_eval
+from retrievalSystem import RetrievalSystem, RETRIEVE_METHOD
+from collectionManager import CollectionManager
+from usersRegistry import UsersRegistry
+from suggestionCache import SuggestionCache
+from audioCache import AudioTranscodeCache
+from thumbnailStore import ThumbnailStore
 
 import csv
 import ssl
+import gzip
+import base64
+from werkzeug.security import safe_join
 
 load_dotenv()
 
@@ -21,11 +26,42 @@ SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 API_KEY = os.getenv("API_KEY")
 SPEAKER_PROFILE_OUTPUT_PATH = os.getenv("SPEAKER_PROFILE_OUTPUT_PATH")
 CLIENT_AUDIO_UPLOAD_PATH = os.getenv("CLIENT_AUDIO_UPLOAD_PATH")
+SPEAKER_PROFILES_PATH = os.path.join(SCRIPT_DIRECTORY, "speaker_profiles")
+MAX_BULK_PROFILES = int(os.getenv("MAX_BULK_PROFILES", 64))
 USERS_TSV_FILENAME=os.getenv("USERS_TSV_FILENAME")
 USERS_TSV_PATH = os.path.join(SCRIPT_DIRECTORY, USERS_TSV_FILENAME)
 
 COLL_CSV_FILENAME=os.getenv("COLL_CSV_FILENAME")
 COLL_CSV_PATH = os.path.join(SCRIPT_DIRECTORY, COLL_CSV_FILENAME)
+COLL_STORE_PATH = os.path.join(SCRIPT_DIRECTORY, os.getenv("COLL_STORE_DIRNAME", "collection_store"))
+COLL_RELOAD_INTERVAL = float(os.getenv("COLL_RELOAD_INTERVAL", 30))
+COLL_INGEST_PATTERN = os.path.join(SCRIPT_DIRECTORY, os.getenv("COLL_INGEST_PATTERN")) if os.getenv("COLL_INGEST_PATTERN") else None
+COLL_INGEST_CHUNK_SIZE = int(os.getenv("COLL_INGEST_CHUNK_SIZE", 1000))
+
+USE_ANN_INDEX = (os.getenv("USE_ANN_INDEX", "false").lower() in ["true", "1", "on"])
+ANN_INDEX_PATH = os.path.join(SCRIPT_DIRECTORY, os.getenv("ANN_INDEX_FILENAME", "ann_index.npz")) if USE_ANN_INDEX else None
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", 8))
+
+SUGGESTION_CACHE_SIZE = int(os.getenv("SUGGESTION_CACHE_SIZE", 1024))
+SUGGESTION_CACHE_TTL = float(os.getenv("SUGGESTION_CACHE_TTL", 300))
+NUM_SUGGESTIONS = 10
+MAX_BATCH_GROUPS = int(os.getenv("MAX_BATCH_GROUPS", 1000))
+# the fields of the suggested news sent when the request does not ask for specific ones (the client needs only these)
+SUGGESTION_FIELDS = os.getenv("SUGGESTION_FIELDS", "Link,Title,Summary,Embedding,wav_file_name,thumbnail").split(',')
+
+THUMBNAILS_PATH = os.path.join(SCRIPT_DIRECTORY, os.getenv("THUMBNAILS_DIRNAME", "thumbnails"))
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", 350))
+THUMBNAILS_MAX_AGE = 365 * 24 * 3600
+COMPUTE_THUMBNAILS = (os.getenv("COMPUTE_THUMBNAILS", "true").lower() in ["true", "1", "on"])
+
+AUDIO_NEWS_PATH = os.path.join(SCRIPT_DIRECTORY, "generated_audio")
+AUDIO_CACHE_PATH = os.path.join(SCRIPT_DIRECTORY, os.getenv("AUDIO_CACHE_DIRNAME", "audio_cache"))
+AUDIO_BITRATE = os.getenv("AUDIO_BITRATE", "48k")
+AUDIO_MAX_AGE = int(os.getenv("AUDIO_MAX_AGE", 86400))
+
+GZIP_RESPONSES = (os.getenv("GZIP_RESPONSES", "true").lower() in ["true", "1", "on"])
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", 1024))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 5))
 
 FEEDBACK_CSV_PATH = os.path.join(SCRIPT_DIRECTORY, os.getenv("FEEDBACK_CSV_FILENAME"))
 
@@ -43,6 +79,16 @@ FEEDBACK_TO_DESCRIPTIVE_MSG = {
     pveagle.EagleProfilerEnrollFeedback.QUALITY_ISSUE: 'Low audio quality due to bad microphone or environment'
 }
 
+def parse_fields(fields_arg):
+    """
+    parses the 'fields' parameter of /news_suggestion, returning None for every field
+    """
+    if fields_arg is None or fields_arg.strip() == "":
+        return SUGGESTION_FIELDS
+    if fields_arg.strip().lower() == "all":
+        return None
+    return list(dict.fromkeys(field.strip() for field in fields_arg.split(',') if field.strip() != ""))
+
 def get_csv_header(file_path):
     with open(file_path, 'r', newline='') as csvfile:
         reader = csv.reader(csvfile)
@@ -68,46 +114,18 @@ def append_to_feedback_csv(data : dict):
 
         writer.writerow(data)
 
-def get_users_df():
+suggestion_cache = SuggestionCache(SUGGESTION_CACHE_SIZE, SUGGESTION_CACHE_TTL)
 
-    def f(x):
-        x = str(x)
-        if "," not in x:
-            x = x.replace(" ", ", ")
-        try:
-            return literal_eval(str(x))
-        except Exception as e:
-            print(e)
-            print("given x:" , x)
-            return []
-        
-    conv = {'interests': lambda x: f(x)}
-
-    if os.path.exists(USERS_TSV_PATH):
-        return pd.read_csv(USERS_TSV_PATH, sep='\t', converters=conv)
-    return None
-
-coll_df = None
-
-def load_collection_df():
-    global coll_df
-    if coll_df is not None:
-        return coll_df
-    def f(x):
-        x = str(x)
-        if "," not in x:
-            x = x.replace(" ", ", ")
-        try:
-            return literal_eval(str(x))
-        except Exception as e:
-            print(e)
-            print("given x:" , x)
-            return []
-    conv = {'Embedding': lambda x: f(x)}
-    coll_df = pd.read_csv(COLL_CSV_PATH, converters=conv, index_col=0)
-    print(f"Loaded dataframe of {len(coll_df)} rows")
-    return coll_df
+# when a user (re)registers, the cached suggestions of the passengers sets including that user are stale
+users_registry = UsersRegistry(USERS_TSV_PATH, on_users_changed=suggestion_cache.invalidate_users)
 
+audio_cache = AudioTranscodeCache(AUDIO_NEWS_PATH, AUDIO_CACHE_PATH, AUDIO_BITRATE)
+
+# the thumbnails are always served, but computed only if COMPUTE_THUMBNAILS (otherwise with: python thumbnailStore.py build)
+thumbnail_store = ThumbnailStore(THUMBNAILS_PATH, THUMBNAIL_SIZE)
+
+collection_manager = CollectionManager(COLL_CSV_PATH, COLL_STORE_PATH, COLL_RELOAD_INTERVAL, COLL_INGEST_PATTERN, COLL_INGEST_CHUNK_SIZE, ANN_INDEX_PATH,
+                                       thumbnail_store, COMPUTE_THUMBNAILS)
 
 import numpy as np
 
@@ -158,10 +176,21 @@ def webm_opus_to_wav(webm_file_path, wav_file_path):
     audio = audio.set_sample_width(2)
     audio.export(wav_file_path, format="wav")
 
+def profile_etag(profile_path):
+    """
+    returns the ETag of the given speaker profile, the same for every worker as it only depends on the file stats;
+    a profile re-enrolled (rewritten) gets a new one
+    """
+    stat = os.stat(profile_path)
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
 def create_app():
     app = Flask(__name__)
     CORS(app)  # Enable CORS for all routes
 
+    # picks up new versions of the collection and new crawls without restarting the server
+    collection_manager.start_watching()
+
     @app.route('/', methods=['GET']) 
     def render_html():
         return render_template("registration.html")
@@ -210,18 +239,10 @@ def create_app():
 
             try:
                 
-                # check if csv already exists
-                if os.path.exists(USERS_TSV_PATH):
-                    df = pd.read_csv(USERS_TSV_PATH, sep='\t')
-                    new_user = {'username': username, 'interests': embeddings}
-                    if username in df['username'].values:
-                        print("Username already exists, aborting registration.")
-                        return jsonify({'success': False, 'error': 'Username already exists, please choose another one'})
-                    df = pd.concat([df, pd.DataFrame([new_user])], ignore_index=True)
-                else:
-                    df = pd.DataFrame({'username': [username], 'interests': [embeddings]})
-
-                df.to_csv(USERS_TSV_PATH, index=False, sep='\t')
+                # appends the user to the registry, which also checks that the username is not taken
+                if not users_registry.add(username, embeddings):
+                    print("Username already exists, aborting registration.")
+                    return jsonify({'success': False, 'error': 'Username already exists, please choose another one'})
 
                 # start voice enrolling phase 
                 enroll_percentage = 0.0
@@ -266,22 +287,78 @@ def create_app():
         """
         returns the list of registered users
         """
-        df = get_users_df()
-        return Response(df.to_json(orient="records"), mimetype='application/json')
+        return Response(users_registry.to_json(), mimetype='application/json')
 
     @app.route('/speaker_profiles/<path:path>')
     def send_profile(path):
         """
-        speaker profiles filename are in the form 'username.pv'
+        speaker profiles filename are in the form 'username.pv'.
+        Supports conditional requests: If-None-Match (with the ETag of the local copy) or If-Modified-Since
+        are answered 304 Not Modified if the profile did not change
         """
-        return send_from_directory('speaker_profiles', path)
+        profile_path = safe_join(SPEAKER_PROFILES_PATH, path)
+        if profile_path is None or not os.path.isfile(profile_path):
+            abort(404)
+        return send_file(profile_path, conditional=True, etag=profile_etag(profile_path), max_age=0)
+
+    @app.route('/speaker_profiles/bulk', methods=['POST'])
+    def send_profiles_bulk():
+        """
+            Client asks for the speaker profiles of many users at once (e.g. all the passengers boarding a vehicle).
+            The json body must contain 'profiles': an object mapping each username to the ETag of its local copy of
+            the profile, or null if it has none.
+
+            returns a json object with
+            - 'profiles': username -> {'etag', 'data' (the base64 encoded profile)}, only for the changed profiles
+            - 'not_modified': the usernames whose local copy is up to date
+            - 'missing': the usernames without a profile on the server
+        """
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get("profiles"), dict):
+            return jsonify({'success': False, 'error': '\'profiles\' object was not given'}), 400
+        if len(body["profiles"]) > MAX_BULK_PROFILES:
+            return jsonify({'success': False, 'error': f'at most {MAX_BULK_PROFILES} profiles per request'}), 400
+
+        profiles, not_modified, missing = {}, [], []
+        for (username, local_etag) in body["profiles"].items():
+            profile_path = safe_join(SPEAKER_PROFILES_PATH, f"{username}.pv")
+            if profile_path is None or not os.path.isfile(profile_path):
+                missing.append(username)
+                continue
+            etag = profile_etag(profile_path)
+            if etag == local_etag:
+                not_modified.append(username)
+                continue
+            with open(profile_path, "rb") as f:
+                profiles[username] = {'etag': etag, 'data': base64.b64encode(f.read()).decode('ascii')}
+        return jsonify({'profiles': profiles, 'not_modified': not_modified, 'missing': missing})
 
     @app.route('/audio-news/<path:path>')
     def get_audio_news(path):
         """
-        audio news are wav file whose file name is indicated in their corresponding collection.csv row
+        audio news are wav file whose file name is indicated in their corresponding collection.csv row.
+        ?format=ogg returns the OGG Vorbis version, a fraction of the size, transcoded once and then cached on disk.
+        Both support conditional (ETag) and Range requests, so an interrupted download can be resumed
+        """
+        if request.args.get("format", "wav").lower() == "ogg":
+            try:
+                ogg_path, digest = audio_cache.get(path)
+            except FileNotFoundError:
+                abort(404)
+            # the cache is content-addressed: the digest changes whenever the wav is regenerated
+            return send_file(ogg_path, mimetype="audio/ogg", conditional=True, etag=digest, max_age=AUDIO_MAX_AGE)
+        return send_from_directory('generated_audio', path, conditional=True)
+
+    @app.route('/thumbnails/<path:path>')
+    def get_thumbnail(path):
         """
-        return send_from_directory('generated_audio', path)
+        thumbnails are square jpeg files whose file name is the 'thumbnail' field of the suggested news.
+        The name is a hash of the content, so a client never needs to download the same thumbnail twice
+        """
+        response = send_from_directory(THUMBNAILS_PATH, path, max_age=THUMBNAILS_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
 
     @app.route('/feedback-form', methods=['GET'])
     def collect_user_feedback():
@@ -326,6 +403,9 @@ def create_app():
     def news_suggestion():
         """
             ?users GET paramter must contain the list of users separated by a ';' semicolon
+            ?fields optional GET parameter: the fields of the news to be returned separated by a ',' comma
+                    (e.g. 'Link,Title,score'), or 'all' for every field but the 'Article' one (see /news_article);
+                    defaults to SUGGESTION_FIELDS
             Client asks for a news to propose, given the passengers on board
 
             passengers_usernames: the list of passengers on board
@@ -336,11 +416,108 @@ def create_app():
             return jsonify({'success': False, 'error': '\'users\' parameter was not given'})
         passengers_usernames = request.args["users"].split(";")
         print("received passengers names: ", passengers_usernames)
-        users_df = get_users_df()
-        passengers_embeddings = users_df[users_df['username'].isin(passengers_usernames)]['interests'].to_list()
-        coll = load_collection_df()
-        ret_json = RetrievalSystem.retrieve(coll, passengers_embeddings, 10)
-        return Response(ret_json, mimetype='application/json')
+        fields = parse_fields(request.args.get("fields"))
+        # picks up the users registered meanwhile (also by other workers), invalidating their cached suggestions
+        users_registry.refresh()
+        # the snapshot is not affected by collection reloads happening while the request is served
+        snapshot = collection_manager.get_snapshot()
+
+        # approximate results are cached apart from the exact ones
+        retrieve_method = RETRIEVE_METHOD if snapshot.ann_index is None else f"{RETRIEVE_METHOD}+ivf{ANN_NPROBE}"
+        cache_key = SuggestionCache.make_key(passengers_usernames, retrieve_method, NUM_SUGGESTIONS, snapshot.version, fields)
+        ret_json = suggestion_cache.get(cache_key)
+        if ret_json is not None:
+            return Response(ret_json, mimetype='application/json', headers={'X-Cache': 'HIT'})
+
+        passengers_embeddings = users_registry.get_embeddings(passengers_usernames)
+        ret_json = RetrievalSystem.retrieve(snapshot, passengers_embeddings, NUM_SUGGESTIONS, snapshot.embeddings,
+                                            snapshot.ann_index, ANN_NPROBE, fields)
+        suggestion_cache.put(cache_key, ret_json)
+        return Response(ret_json, mimetype='application/json', headers={'X-Cache': 'MISS'})
+
+    @app.route('/news_suggestion/batch', methods=['POST'])
+    def news_suggestion_batch():
+        """
+            Back office asks for the news to propose to many vehicles at once.
+            The json body must contain 'groups': the list of the passengers usernames of each vehicle,
+            and optionally 'fields' as in /news_suggestion (a ',' separated string)
+
+            returns the json list of the suggested news lists, one per group and in the same order
+        """
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get("groups"), list):
+            return jsonify({'success': False, 'error': '\'groups\' list was not given'}), 400
+        groups = [[str(username) for username in group] for group in body["groups"] if isinstance(group, list)]
+        if len(groups) != len(body["groups"]):
+            return jsonify({'success': False, 'error': 'every group must be a list of usernames'}), 400
+        if len(groups) > MAX_BATCH_GROUPS:
+            return jsonify({'success': False, 'error': f'at most {MAX_BATCH_GROUPS} groups per request'}), 400
+        fields = parse_fields(body.get("fields"))
+
+        users_registry.refresh()
+        snapshot = collection_manager.get_snapshot()
+
+        # the batch always scores the whole collection, so its entries are the exact ones of /news_suggestion
+        cache_keys = [SuggestionCache.make_key(group, RETRIEVE_METHOD, NUM_SUGGESTIONS, snapshot.version, fields) for group in groups]
+        results = [suggestion_cache.get(cache_key) for cache_key in cache_keys]
+        missing = [group_id for (group_id, result) in enumerate(results) if result is None]
+
+        if len(missing) > 0:
+            # every distinct passenger is embedded once, however many groups include it
+            embeddings_by_username = users_registry.get_embeddings_by_username([username for group_id in missing for username in groups[group_id]])
+            users_rows = {username: row for (row, username) in enumerate(embeddings_by_username)}
+            users_matrix = np.array(list(embeddings_by_username.values()), dtype=np.float32)
+            missing_groups = [[users_rows[username] for username in groups[group_id] if username in users_rows] for group_id in missing]
+
+            ret_jsons = RetrievalSystem.retrieve_batch(snapshot, users_matrix, missing_groups, NUM_SUGGESTIONS, snapshot.embeddings, fields)
+            for (group_id, ret_json) in zip(missing, ret_jsons):
+                results[group_id] = ret_json
+                suggestion_cache.put(cache_keys[group_id], ret_json)
+
+        print(f"[batch] {len(groups)} groups, {len(groups) - len(missing)} served from the cache")
+        return Response("[" + ",".join(results) + "]", mimetype='application/json')
+
+    @app.route('/news_article', methods=['GET'])
+    def news_article():
+        """
+            ?link GET parameter must contain the Link of a news
+            Client asks for the full text of a news, which is not part of the suggestions
+
+            returns a json object with the 'Link', 'Title' and 'Article' of the news
+        """
+        if "link" not in request.args:
+            return jsonify({'success': False, 'error': '\'link\' parameter was not given'}), 400
+        snapshot = collection_manager.get_snapshot()
+        row = snapshot.get_row(request.args["link"])
+        if row is None:
+            return jsonify({'success': False, 'error': 'news not found'}), 404
+        news = snapshot.take([row], ['Link', 'Title', 'Article'])
+        return Response(news.iloc[0].to_json(), mimetype='application/json')
+
+    @app.route('/stats/suggestion-cache', methods=['GET'])
+    def suggestion_cache_stats():
+        """
+        returns the hit/miss counters of the /news_suggestion cache of this worker
+        """
+        return jsonify(suggestion_cache.stats())
+
+    @app.after_request
+    def gzip_json_response(response):
+        """
+        compresses the json responses (e.g. the news suggestions, mostly made of embeddings and summaries)
+        for the clients accepting gzip; files are served as they are, so that their Range requests keep working
+        """
+        if not GZIP_RESPONSES or response.direct_passthrough or response.mimetype != 'application/json':
+            return response
+        response.vary.add('Accept-Encoding')
+        if 'gzip' not in request.headers.get('Accept-Encoding', '').lower() or 'Content-Encoding' in response.headers:
+            return response
+        data = response.get_data()
+        if len(data) < GZIP_MIN_SIZE:
+            return response
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
     
     return app
 
@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class SuggestionCache:
+    """
+    bounded LRU cache with time-to-live of the /news_suggestion responses.
+    Keys are built by make_key() from the passengers set, the retrieval method, the number of results, the collection version
+    and the returned fields, so a new collection version never hits the entries of the previous one.
+    The entries of a passengers set are dropped when the embedding of one of its users changes, see invalidate_users()
+    """
+
+    def __init__(self, max_entries = 1024, ttl = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.__entries = OrderedDict()  # key -> (insertion time, value)
+        self.__keys_by_user = {}  # username -> set of keys whose passengers set contains it
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(passengers_usernames : list[str], retrieve_method : str, num_results : int, collection_version : str, fields : list[str] = None):
+        return (tuple(sorted(set(passengers_usernames))), retrieve_method, num_results, collection_version,
+                None if fields is None else tuple(fields))
+
+    def get(self, key):
+        """
+        returns the cached value for the given key, None if missing or expired
+        """
+        if self.max_entries <= 0:
+            return None
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and self.ttl > 0 and time.monotonic() - entry[0] > self.ttl:
+                self.__remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (time.monotonic(), value)
+            for username in key[0]:
+                self.__keys_by_user.setdefault(username, set()).add(key)
+            while len(self.__entries) > self.max_entries:
+                self.__remove(next(iter(self.__entries)))
+                self.evictions += 1
+
+    def invalidate_users(self, usernames : list[str]):
+        """
+        drops the entries of every passengers set containing one of the given users
+        """
+        with self.__lock:
+            for username in usernames:
+                for key in list(self.__keys_by_user.get(username, ())):
+                    self.__remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__keys_by_user.clear()
+
+    def stats(self) -> dict:
+        with self.__lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.__entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups > 0 else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def __remove(self, key):
+        """
+        has to be called holding the lock
+        """
+        self.__entries.pop(key, None)
+        for username in key[0]:
+            keys = self.__keys_by_user.get(username)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.__keys_by_user[username]
@@ -0,0 +1,228 @@
+"""
+Thumbnails of the news, resolved from the article pages, cropped and resized once on the server.
+
+For each article the picture named by its og:image / twitter:image metadata (or else the first large enough <img>
+of the page) is downloaded, center-cropped to a square and resized to THUMBNAIL_SIZE pixels, then saved as a jpeg
+named after the hash of its content: the file of a given name never changes, so it can be cached by the clients forever.
+index.json maps every processed article Link to its thumbnail file (null if the page had no usable picture).
+
+Thumbnails are computed when news are ingested (see CollectionManager), or for the whole collection with:
+    python thumbnailStore.py build
+"""
+import argparse
+import hashlib
+import json
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import urljoin
+
+import requests
+from bs4 import BeautifulSoup
+from dotenv import load_dotenv
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:  # Windows: every worker computes the thumbnails
+    fcntl = None
+
+load_dotenv()
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+INDEX_FILENAME = "index.json"
+LOCK_FILENAME = ".lock"
+THUMBNAIL_META = [("property", "og:image"), ("property", "og:image:secure_url"), ("name", "twitter:image"), ("name", "twitter:image:src")]
+MIN_SOURCE_SIZE = 200
+MAX_CANDIDATES = 20
+# returned for the articles that could not be processed (e.g. network errors), which are retried at the next ingestion
+FAILED = object()
+
+def find_thumbnail_url(article_link):
+    """
+    returns the url of the picture representing the given article, None if its page has no large enough picture
+    """
+    response = requests.get(article_link, timeout=(5, 15))
+    response.raise_for_status()
+    soup = BeautifulSoup(response.content, 'html.parser')
+
+    for (attribute, value) in THUMBNAIL_META:
+        meta = soup.find('meta', attrs={attribute: value})
+        if meta is not None and meta.get('content'):
+            return urljoin(article_link, meta['content'])
+
+    for img in soup.find_all('img')[:MAX_CANDIDATES]:
+        src = img.get('src')
+        if not src or src.startswith('data:'):
+            continue
+        try:
+            width, height = int(img.get('width', 0)), int(img.get('height', 0))
+        except ValueError:
+            width, height = 0, 0
+        # pictures declaring a small size in the page are skipped without downloading them
+        if (width and width < MIN_SOURCE_SIZE) or (height and height < MIN_SOURCE_SIZE):
+            continue
+        return urljoin(article_link, src)
+    return None
+
+def make_thumbnail(image_bytes, size) -> Image.Image:
+    """
+    returns the picture center-cropped to a square and resized to size x size, None if it is too small
+    """
+    img = Image.open(BytesIO(image_bytes))
+    width, height = img.size
+    if width < MIN_SOURCE_SIZE or height < MIN_SOURCE_SIZE:
+        return None
+    side = min(width, height)
+    left, top = (width - side) // 2, (height - side) // 2
+    return img.convert("RGB").crop((left, top, left + side, top + side)).resize((size, size), Image.LANCZOS)
+
+
+class ThumbnailStore:
+
+    def __init__(self, directory, size = 350, max_workers = 4):
+        self.directory = directory
+        self.size = size
+        self.max_workers = max_workers
+        self.__index_path = os.path.join(directory, INDEX_FILENAME)
+        self.__index = {}  # article link -> thumbnail filename, None if the article has none
+        self.__index_mtime = None
+        self.__lock = threading.Lock()
+        self.__queue = None
+        self.__reload_index()
+
+    def get(self, link):
+        """
+        returns the thumbnail filename of the given article, None if it has none or it was not processed yet
+        """
+        self.__reload_index()
+        return self.__index.get(link)
+
+    def process(self, links) -> int:
+        """
+        computes, in parallel, the thumbnails of the given articles that were never processed, returns how many were found
+        """
+        self.__reload_index()
+        links = [link for link in dict.fromkeys(links) if isinstance(link, str) and link not in self.__index]
+        if len(links) == 0:
+            return 0
+        os.makedirs(self.directory, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            filenames = list(executor.map(self.__process_one, links))
+        processed = {link: filename for (link, filename) in zip(links, filenames) if filename is not FAILED}
+        with self.__lock:
+            self.__index.update(processed)
+            self.__save_index()
+        found = sum(filename is not None for filename in processed.values())
+        print(f"Computed {found} thumbnails for {len(links)} news ({len(links) - len(processed)} failed)")
+        return found
+
+    def process_in_background(self, links):
+        """
+        queues the given articles to be processed by a daemon thread, so the ingestion never waits for the publishers
+        """
+        with self.__lock:
+            if self.__queue is None:
+                self.__queue = queue.Queue()
+                threading.Thread(target=self.__background_worker, daemon=True, name="thumbnails").start()
+        self.__queue.put(list(links))
+
+    def __background_worker(self):
+        while True:
+            links = self.__queue.get()
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(os.path.join(self.directory, LOCK_FILENAME), "a") as lock_file:
+                    if fcntl is not None:
+                        try:
+                            # every gunicorn worker ingests the same news: only one of them downloads their thumbnails
+                            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except BlockingIOError:
+                            continue
+                    self.process(links)
+            except Exception as e:
+                print(f"[!] Thumbnails computation error: {e}")
+
+    def __process_one(self, link):
+        """
+        returns the filename of the thumbnail written for the given article, None if it has no usable picture
+        """
+        try:
+            image_url = find_thumbnail_url(link)
+            if image_url is None:
+                return None
+            response = requests.get(image_url, timeout=(5, 30))
+            response.raise_for_status()
+            thumbnail = make_thumbnail(response.content, self.size)
+            if thumbnail is None:
+                return None
+            buffer = BytesIO()
+            thumbnail.save(buffer, format="jpeg", quality=85, optimize=True)
+            data = buffer.getvalue()
+            filename = hashlib.sha256(data).hexdigest()[:32] + ".jpg"
+            path = os.path.join(self.directory, filename)
+            if not os.path.exists(path):
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            return filename
+        except Exception as e:
+            print(f"[!] Cannot compute the thumbnail of {link}: {e}")
+            return FAILED
+
+    def __reload_index(self):
+        """
+        re-reads the index when another process (e.g. the build command, another worker) rewrote it
+        """
+        try:
+            mtime = os.path.getmtime(self.__index_path)
+        except OSError:
+            return
+        if mtime == self.__index_mtime:
+            return
+        with self.__lock:
+            try:
+                with open(self.__index_path, "r") as f:
+                    index = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"[!] Cannot read the thumbnails index: {e}")
+                return
+            index.update(self.__index)
+            self.__index, self.__index_mtime = index, mtime
+
+    def __save_index(self):
+        """
+        has to be called holding the lock; merges the entries written meanwhile by the other processes
+        """
+        try:
+            with open(self.__index_path, "r") as f:
+                on_disk = json.load(f)
+        except (OSError, ValueError):
+            on_disk = {}
+        on_disk.update(self.__index)
+        self.__index = on_disk
+        tmp_path = f"{self.__index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.__index, f)
+        os.replace(tmp_path, self.__index_path)
+        self.__index_mtime = os.path.getmtime(self.__index_path)
+
+
+if __name__ == '__main__':
+    from collectionManager import CollectionManager
+
+    parser = argparse.ArgumentParser(description="Computes the thumbnails of the news of the collection")
+    parser.add_argument("command", choices=["build"])
+    args = parser.parse_args()
+
+    if args.command == "build":
+        collection_manager = CollectionManager(os.path.join(SCRIPT_DIRECTORY, os.getenv("COLL_CSV_FILENAME")),
+                                               os.path.join(SCRIPT_DIRECTORY, os.getenv("COLL_STORE_DIRNAME", "collection_store")),
+                                               reload_interval=0)
+        snapshot = collection_manager.get_snapshot()
+        store = ThumbnailStore(os.path.join(SCRIPT_DIRECTORY, os.getenv("THUMBNAILS_DIRNAME", "thumbnails")), int(os.getenv("THUMBNAIL_SIZE", 350)))
+        store.process(snapshot.links().keys())
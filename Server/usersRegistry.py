@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+from ast import literal_eval
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: registrations are only serialized within the process
+    fcntl = None
+
+TSV_HEADER = "username\tinterests\n"
+
+def parse_interests(x):
+    """
+    parses an 'interests' cell of the users tsv, returning an empty list if it is malformed
+    """
+    x = str(x)
+    if "," not in x:
+        x = x.replace(" ", ", ")
+    try:
+        return literal_eval(str(x))
+    except Exception as e:
+        print(e)
+        print("given x:" , x)
+        return []
+
+
+class UsersRegistry:
+    """
+    in-memory index username -> interests embedding of the registered users, backed by the append-only users tsv.
+    The tsv is parsed once; afterwards only the lines appended since the last read (e.g. by another gunicorn worker)
+    are parsed, and a registration appends a single line instead of rewriting the whole file
+
+    on_users_changed: called with the list of the usernames whose embedding was (re)loaded
+    """
+
+    def __init__(self, tsv_path, on_users_changed = None):
+        self.tsv_path = tsv_path
+        self.on_users_changed = on_users_changed
+        self.__users = {}  # username -> (interests as list, interests as normalized float32 vector)
+        self.__read_offset = 0
+        self.__json = None
+        self.__lock = threading.Lock()
+
+    def refresh(self) -> list[str]:
+        """
+        reads the users appended to the tsv since the last call, returns their usernames.
+        Costs a single stat() when nothing changed
+        """
+        try:
+            size = os.path.getsize(self.tsv_path)
+        except OSError:
+            return []
+        if size == self.__read_offset:
+            return []
+        with self.__lock:
+            return self.__read_new_lines()
+
+    def get_embeddings(self, usernames : list[str]) -> list[np.ndarray]:
+        """
+        returns the normalized interests embeddings of the given users, skipping the unknown ones
+        """
+        return list(self.get_embeddings_by_username(usernames).values())
+
+    def get_embeddings_by_username(self, usernames : list[str]) -> dict:
+        """
+        returns username -> normalized interests embedding of the given users, skipping the unknown ones
+        """
+        self.refresh()
+        users = self.__users
+        return {username: users[username][1] for username in dict.fromkeys(usernames) if username in users}
+
+    def get_usernames(self) -> list[str]:
+        self.refresh()
+        return list(self.__users.keys())
+
+    def to_json(self) -> str:
+        """
+        returns the json list of the registered users, whose fields are 'username' and 'interests'
+        """
+        self.refresh()
+        ret = self.__json
+        if ret is None:
+            ret = self.__json = json.dumps([{'username': username, 'interests': interests} for (username, (interests, _)) in self.__users.items()])
+        return ret
+
+    def add(self, username : str, interests : list[float]) -> bool:
+        """
+        registers a new user appending it to the tsv, returns False if the username is already taken
+        """
+        with self.__lock:
+            with open(self.tsv_path, "a", encoding="utf-8", newline="") as f:
+                if fcntl is not None:
+                    # serializes the check and the append among the gunicorn workers
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    self.__read_new_lines()
+                    if username in self.__users:
+                        return False
+                    if f.tell() == 0:
+                        f.write(TSV_HEADER)
+                    elif not self.__ends_with_newline():
+                        f.write("\n")
+                    f.write(f"{username}\t{json.dumps(list(interests))}\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+            self.__read_new_lines()
+        return True
+
+    def __ends_with_newline(self) -> bool:
+        with open(self.tsv_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def __read_new_lines(self) -> list[str]:
+        """
+        parses the complete lines appended after the last read offset; has to be called holding the lock
+        """
+        if not os.path.exists(self.tsv_path):
+            return []
+        with open(self.tsv_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < self.__read_offset:
+                # the file was rewritten (e.g. edited by hand): reload it from scratch
+                self.__users = {}
+                self.__read_offset = 0
+            f.seek(self.__read_offset)
+            data = f.read()
+
+        # a line still being written by another process is left for the next read
+        end = data.rfind(b"\n") + 1
+        added = []
+        for line in data[:end].decode("utf-8").splitlines():
+            if line.strip() == "" or line == TSV_HEADER.strip():
+                continue
+            username, _, interests = line.partition("\t")
+            interests = parse_interests(interests)
+            if username in self.__users:
+                continue
+            vector = np.asarray(interests, dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            self.__users[username] = (interests, vector / norm if norm > 0 else vector)
+            added.append(username)
+
+        self.__read_offset += end
+        if end > 0:
+            self.__json = None
+        if len(added) > 0 and self.on_users_changed is not None:
+            self.on_users_changed(added)
+        return added